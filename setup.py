@@ -38,10 +38,14 @@ setup(
         "ofxstatement":
         [
             "bancoposta = ofxstatement.plugins.bancoposta:BancoPostaPlugin"
+        ],
+        "console_scripts":
+        [
+            "ofxstatement-bancoposta = ofxstatement.plugins.bancopostacli:main"
         ]
     },
     install_requires=["ofxstatement", "pandas", "tabula-py", "pypdf2"],
-    extras_require={"test": ["pytest"]},
+    extras_require={"test": ["pytest"], "arrow": ["pyarrow"]},
     include_package_data=True,
     zip_safe=True,
 )
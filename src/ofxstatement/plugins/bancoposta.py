@@ -1,68 +1,166 @@
+import io
 import os
+from datetime import datetime
+from typing import Optional
+
+from ofxstatement.plugins.bancopostaarchive import BancoPostaArchiveParser, COMPRESSIONS, is_archive, split_compression
 from ofxstatement.plugins.bancopostacsvparser import BancoPostaCSVStatementParser
 from ofxstatement.plugins.bancopostapdfparser import BancoPostaPdfStatementParser
+from ofxstatement.plugins.bancopostarules import load_rules
+from ofxstatement.plugins.bancopostalayout import LayoutDetector
+from ofxstatement.plugins.bancopostamemo import DescriptionMemo, DEFAULT_MEMO_SIZE
+from ofxstatement.plugins.bancopostastore import TransactionStore
+from ofxstatement.plugins.bancopostaquarantine import Quarantine
+from ofxstatement.plugins.bancopostaocr import OcrExtractor, OCR_AUTO, DEFAULT_OCR_LANG, DEFAULT_OCR_DPI
 
 from ofxstatement.plugin import Plugin
 
+REQUIRED_COLUMNS = [
+    "Data",
+    "Valuta",
+    "Addebiti",
+    "Accrediti",
+    "Descrizione operazioni",
+]
+
+
 class BancoPostaPlugin(Plugin):
     """BancoPosta"""
 
+    compiled_rules = None
+    layout_detector = None
+    memo = None
+    store = None
+    quarantine = None
+
+    def get_store(self):
+        """Return the transaction store of the 'store' setting, opened once per plugin"""
+        if self.store is None and 'store' in self.settings:
+            self.store = TransactionStore(os.path.expanduser(self.settings['store']))
+        return self.store
+
+    def get_quarantine(self):
+        """Return the quarantine file of the 'quarantine' setting, shared by all the parsers of this plugin"""
+        if self.quarantine is None and 'quarantine' in self.settings:
+            self.quarantine = Quarantine(os.path.expanduser(self.settings['quarantine']))
+        return self.quarantine
+
+    def get_memo(self):
+        """Return the description memo shared by all the parsers of this plugin"""
+        if self.memo is None:
+            size = int(self.settings.get('memo_size', DEFAULT_MEMO_SIZE))
+            if size > 0:
+                self.memo = DescriptionMemo(size)
+        return self.memo
+
+    def get_rules(self):
+        """Return the payee rules of the 'rules' setting, compiled once per plugin"""
+        if self.compiled_rules is None and 'rules' in self.settings:
+            self.compiled_rules = load_rules(os.path.expanduser(self.settings['rules']), self.settings.get('cache_dir'))
+        return self.compiled_rules
+
+    def configure(self, parser):
+        """Apply the plugin settings shared by the CSV and PDF parsers"""
+        if 'account' in self.settings:
+            parser.statement.account_id = self.settings['account']
+        else:
+            parser.statement.account_id = 'BancoPosta'
+
+        if 'currency' in self.settings:
+            parser.statement.currency = self.settings.get('currency', 'EUR')
+
+        if 'date_format' in self.settings:
+            parser.date_format = self.settings['date_format']
+
+        if 'balance_check' in self.settings:
+            parser.balance_check = self.settings['balance_check']
+
+        # Dates as YYYY-MM-DD, both included
+        if self.settings.get('since'):
+            parser.since = datetime.strptime(self.settings['since'], '%Y-%m-%d')
+        if self.settings.get('until'):
+            parser.until = datetime.strptime(self.settings['until'], '%Y-%m-%d')
+
+        if 'on_error' in self.settings:
+            parser.on_error = self.settings['on_error']
+        parser.quarantine = self.get_quarantine()
+
+        parser.rules = self.get_rules()
+        parser.memo = self.get_memo()
+        if self.get_store() is not None:
+            parser.sinks.append(self.store)
+
+        parser.statement.bank_id = self.settings.get('bank', 'BancoPosta')
+
     def get_parser(self, filename: str):
-        extension = os.path.splitext(filename)[1]
+        if is_archive(filename):
+            return BancoPostaArchiveParser(self, filename)
 
-        required_columns = [
-            "Data",
-            "Valuta",
-            "Addebiti",
-            "Accrediti",
-            "Descrizione operazioni",
-        ]
+        extension, compression = split_compression(filename)
 
         if extension == '.csv':
+            if compression:
+                f = io.TextIOWrapper(COMPRESSIONS[compression](filename, "rb"), encoding='utf-8')
+                return self.get_csv_parser(f, filename, plain=False)
             f = open(filename, "r", encoding='utf-8')
-            signature = f.readline()
+            return self.get_csv_parser(f, filename)
+        elif extension == '.pdf':
+            if compression:
+                with COMPRESSIONS[compression](filename, "rb") as f:
+                    return self.get_pdf_parser(filename, f.read())
+            return self.get_pdf_parser(filename)
+        else:
+            print('Unsupported file type')
 
-            csv_columns = [col.strip() for col in signature.split(";")]
-            
-            if set(required_columns).issubset(csv_columns):
-                f.seek(0)
-                parser = BancoPostaCSVStatementParser(f)
-                parser.columns = {col: csv_columns.index(col) for col in csv_columns}
-                if 'account' in self.settings:
-                    parser.statement.account_id = self.settings['account']
-                else:
-                    parser.statement.account_id = 'BancoPosta'
-
-                if 'currency' in self.settings:
-                    parser.statement.currency = self.settings.get('currency', 'EUR')
-
-                if 'date_format' in self.settings:
-                    parser.date_format = self.settings['date_format']
-            
-                parser.statement.bank_id = self.settings.get('bank', 'BancoPosta')
-                return parser
-
-            # no plugin with matching signature was found
-            raise Exception("No suitable BancoPosta parser "
-                            "found for this statement file.")
+    def get_member_parser(self, name: str, stream):
+        """Return a parser for a statement read from a stream, such as an
+        archive member, or None if it is not a statement"""
+        extension, compression = split_compression(name)
+        if compression:
+            stream = COMPRESSIONS[compression](stream, "rb")
+
+        if extension == '.csv':
+            return self.get_csv_parser(io.TextIOWrapper(stream, encoding='utf-8'), name, plain=False)
         elif extension == '.pdf':
-            # dataFrame = tabula.read_pdf(filename, pages="all")
-            parser = BancoPostaPdfStatementParser(filename)
-            parser.columns = {col: required_columns.index(col) for col in required_columns}
-            if 'account' in self.settings:
-                parser.statement.account_id = self.settings['account']
-            else:
-                parser.statement.account_id = 'BancoPosta'
+            return self.get_pdf_parser(name, stream.read())
+        return None
 
-            if 'currency' in self.settings:
-                parser.statement.currency = self.settings.get('currency', 'EUR')
+    def get_csv_parser(self, f, filename: str, plain: bool = True):
+        signature = f.readline()
 
-            if 'date_format' in self.settings:
-                parser.date_format = self.settings['date_format']
-            
-            parser.statement.bank_id = self.settings.get('bank', 'BancoPosta')
+        csv_columns = [col.strip() for col in signature.split(";")]
+        
+        if set(REQUIRED_COLUMNS).issubset(csv_columns):
+            parser = BancoPostaCSVStatementParser(f)
+            parser.columns = {col: csv_columns.index(col) for col in csv_columns}
+            if plain:
+                f.seek(0)
+                # Chunks are byte ranges of the file
+                parser.workers = int(self.settings.get('csv_workers', 1))
+            else:
+                # Streams are read once: the header is already consumed
+                parser.cur_record = 1
+                parser.filename = filename
+            self.configure(parser)
             return parser
-        else:
-            print('Unsupported file type')
-    
-        
\ No newline at end of file
+
+        # no plugin with matching signature was found
+        raise Exception("No suitable BancoPosta parser "
+                        "found for this statement file.")
+
+    def get_pdf_parser(self, filename: str, data: Optional[bytes] = None):
+        # dataFrame = tabula.read_pdf(filename, pages="all")
+        parser = BancoPostaPdfStatementParser(filename, data)
+        parser.columns = {col: REQUIRED_COLUMNS.index(col) for col in REQUIRED_COLUMNS}
+        if self.layout_detector is None:
+            self.layout_detector = LayoutDetector(self.settings.get('cache_dir'))
+        parser.layout_detector = self.layout_detector
+        if self.settings.get('ocr', OCR_AUTO) == OCR_AUTO:
+            parser.ocr = OcrExtractor(
+                lang=self.settings.get('ocr_lang', DEFAULT_OCR_LANG),
+                dpi=int(self.settings.get('ocr_dpi', DEFAULT_OCR_DPI)),
+                workers=int(self.settings['ocr_workers']) if 'ocr_workers' in self.settings else None,
+                cache_path=self.settings.get('cache_dir'),
+            )
+        self.configure(parser)
+        return parser
@@ -1,5 +1,6 @@
 from enum import Enum
-from ofxstatement.statement import StatementLine, generate_transaction_id
+from ofxstatement.statement import StatementLine
+from ofxstatement.plugins.bancopostaid import extract_reference, generate_id, transaction_key
 import re
 
 class TransactionType(Enum):
@@ -49,16 +50,32 @@ TRANSACTION_TYPES = {
 
 
 class BancoPostaTransaction:
-    def __init__(self, date, settlement_date, amount, description, currency):
+    # Attributes that only depend on the description
+    EXTRACTED_FIELDS = ("payee", "reason", "reference", "operation", "card")
+
+    def __init__(self, date, settlement_date, amount, description, currency, info=None):
         self.date = date
         self.settlement_date = settlement_date
         self.amount = amount
         self.currency = currency
         self.type = None
+        self.id = None
         self.description = description
+        self.category = None
+        if info is not None:
+            # Extracted earlier from the same description
+            self.__dict__.update(info)
+            return
         self.payee = description
+        self.reference = extract_reference(description)
+        self.reason = None
+        self.operation = None
+        self.card = None
         self.extract_info(description)
 
+    def extracted_info(self):
+        return {name: getattr(self, name) for name in self.EXTRACTED_FIELDS}
+
     def extract_info(self, description):
         raise NotImplementedError("This method must be implemented by a subclass")
 
@@ -70,9 +87,28 @@ class BancoPostaTransaction:
         statement_line.memo = self.description
         statement_line.payee = self.payee
         statement_line.currency = self.currency
-        statement_line.id = generate_transaction_id(statement_line)
+        statement_line.id = self.id or generate_id(transaction_key(self))
         return statement_line
 
+    def to_record(self, statement_line):
+        """Flat representation of the transaction, including the extracted
+        fields that a StatementLine cannot hold"""
+        return {
+            "id": statement_line.id,
+            "date": self.date,
+            "settlement_date": self.settlement_date,
+            "amount": self.amount,
+            "currency": self.currency.symbol if self.currency else None,
+            "trntype": statement_line.trntype,
+            "payee": self.payee,
+            "reason": self.reason or None,
+            "memo": self.description,
+            "reference": self.reference,
+            "operation": self.operation,
+            "card": self.card,
+            "category": self.category,
+        }
+
 class CreditTransaction(BancoPostaTransaction):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -296,9 +332,10 @@ class ATMTransaction(BancoPostaTransaction):
     def extract_info(self, description):
         if description.find("PRELIEVO") != -1:
             trntype = "PRELIEVO"
+        elif description.find("VERSAMENTO") != -1:
+            trntype = "VERSAMENTO"
         else:
-            if description.find("VERSAMENTO") != -1:
-                trntype  = "VERSAMENTO"
+            raise ValueError("ATM transaction is neither PRELIEVO nor VERSAMENTO: %s" % description)
 
         self.payee = trntype
 
@@ -0,0 +1,109 @@
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import tarfile
+import zipfile
+from typing import IO, Iterator, List, Optional, Tuple
+
+from ofxstatement.statement import Statement
+
+log = logging.getLogger(__name__)
+
+# Compressed statements are decompressed while they are parsed
+COMPRESSIONS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tgz", ".tbz2", ".txz", ".tar.gz", ".tar.bz2", ".tar.xz")
+
+
+def split_compression(name: str) -> Tuple[str, Optional[str]]:
+    """Return the statement type of a file name (.csv, .pdf...) and its
+    compression suffix, if any"""
+    lower = name.lower()
+    for suffix in COMPRESSIONS:
+        if lower.endswith(suffix):
+            lower = lower[:-len(suffix)]
+            return lower[lower.rfind("."):] if "." in lower else "", suffix
+    return lower[lower.rfind("."):] if "." in lower else "", None
+
+
+def is_archive(name: str) -> bool:
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class StreamMember(io.RawIOBase):
+    """Member of a tar archive read in stream mode, which cannot seek"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def archive_members(filename: str) -> Iterator[Tuple[str, IO[bytes]]]:
+    """Yield (name, stream) for the files of a zip or tar archive, in archive
+    order, reading the archive sequentially. Each stream is only valid until
+    the next member is requested."""
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield info.filename, member
+        return
+
+    # Stream mode: the archive is read once, front to back
+    with tarfile.open(filename, "r|*") as archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, io.BufferedReader(StreamMember(archive.extractfile(info)))
+
+
+class BancoPostaArchiveParser:
+    """Parse all the statements of a zip or tar archive into one statement.
+
+    Members are streamed into the CSV and PDF parsers without being
+    extracted to disk, one at a time. The lines of all the statements are
+    joined, in archive order, with the opening balance of the first one
+    and the closing balance of the last one.
+    """
+
+    def __init__(self, plugin, filename: str):
+        self.plugin = plugin
+        self.filename = filename
+        self.sinks: List = []
+        self.statements: List[Statement] = []
+
+    def parse(self) -> Statement:
+        for name, member in archive_members(self.filename):
+            parser = self.plugin.get_member_parser(f"{self.filename}:{name}", member)
+            if parser is None:
+                log.info(f"{self.filename}: skipping {name}")
+                continue
+            parser.sinks.extend(self.sinks)
+            self.statements.append(parser.parse())
+
+        if not self.statements:
+            log.error(f"{self.filename}: no statements found in the archive")
+            return Statement()
+
+        first, last = self.statements[0], self.statements[-1]
+        statement = Statement(bank_id=first.bank_id, account_id=first.account_id, currency=first.currency)
+        for member_statement in self.statements:
+            statement.lines.extend(member_statement.lines)
+        statement.start_balance = first.start_balance
+        statement.start_date = first.start_date
+        statement.end_balance = last.end_balance
+        statement.end_date = last.end_date
+        return statement
@@ -0,0 +1,128 @@
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+ARROW_EXTENSIONS = (".arrow", ".arrows", ".ipc")
+
+# Columns holding few distinct values, stored dictionary encoded
+DICTIONARY_COLUMNS = ("account_id", "currency", "trntype", "payee", "category")
+
+COLUMNS = [
+    "id", "account_id", "date", "settlement_date", "amount_cents", "currency", "trntype",
+    "payee", "reason", "memo", "reference", "operation", "card", "category",
+]
+
+
+def arrow_schema():
+    dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    types = {
+        "date": pyarrow.date32(),
+        "settlement_date": pyarrow.date32(),
+        "amount_cents": pyarrow.int64(),
+    }
+    return pyarrow.schema([
+        (col, dictionary if col in DICTIONARY_COLUMNS else types.get(col, pyarrow.string()))
+        for col in COLUMNS
+    ])
+
+
+def to_date(value):
+    return value.date() if value is not None else None
+
+
+class ArrowExporter:
+    """Write parsed transactions to a Parquet or Arrow IPC stream file.
+
+    Attach it to the parsers' sinks: transactions are buffered column by
+    column and written as a record batch every batch_size rows, so a whole
+    batch of statements is exported without keeping them in memory. Like
+    the other outputs, the file is written under a temporary name and only
+    renamed over filename once it is complete.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 65536):
+        if pyarrow is None:
+            raise Exception("Arrow/Parquet export requires pyarrow: pip install ofxstatement-bancoposta[arrow]")
+        self.filename = filename
+        self.batch_size = batch_size
+        self.schema = arrow_schema()
+        self.writer = None
+        self.temp = None
+        self.rows = 0
+        self.columns: Dict[str, List] = {col: [] for col in COLUMNS}
+
+    def add_line(self, statement, transaction, stmt_line) -> None:
+        record = transaction.to_record(stmt_line)
+        columns = self.columns
+        columns["id"].append(record["id"])
+        columns["account_id"].append(statement.account_id)
+        columns["date"].append(to_date(record["date"]))
+        columns["settlement_date"].append(to_date(record["settlement_date"]))
+        columns["amount_cents"].append(int(record["amount"] * 100))
+        for col in COLUMNS[5:]:
+            columns[col].append(record[col])
+
+        if len(columns["id"]) >= self.batch_size:
+            self.flush()
+
+    def record_batch(self):
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if pyarrow.types.is_dictionary(field.type):
+                arrays.append(pyarrow.array(values, type=pyarrow.string()).dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def open(self):
+        directory, name = os.path.split(os.path.abspath(self.filename))
+        fd, self.temp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        os.close(fd)
+        if os.path.splitext(self.filename)[1] in ARROW_EXTENSIONS:
+            # The stream format allows a different dictionary in every batch
+            return pyarrow.ipc.new_stream(self.temp, self.schema)
+        return pyarrow.parquet.ParquetWriter(self.temp, self.schema)
+
+    def flush(self) -> None:
+        if not self.columns["id"]:
+            return
+        if self.writer is None:
+            self.writer = self.open()
+        batch = self.record_batch()
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+        self.columns = {col: [] for col in COLUMNS}
+
+    def close(self) -> Optional[int]:
+        """Flush the pending rows and finalize the file, returning the number of rows written"""
+        self.flush()
+        if self.writer is None:
+            # Still produce a valid, empty file
+            self.writer = self.open()
+        self.writer.close()
+        os.replace(self.temp, self.filename)
+        return self.rows
+
+    def discard(self) -> None:
+        """Drop the partial file, leaving any previous export in place"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.temp is not None and os.path.exists(self.temp):
+            os.remove(self.temp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
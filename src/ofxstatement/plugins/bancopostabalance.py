@@ -0,0 +1,140 @@
+import logging
+from decimal import Decimal
+from typing import Optional
+
+from ofxstatement.exceptions import ParseError
+from ofxstatement.statement import Statement
+
+log = logging.getLogger(__name__)
+
+SALDO_INIZIALE = "SALDO INIZIALE"
+SALDO_FINALE = "SALDO FINALE"
+
+# Possible values for the balance_check setting:
+# - strict: abort parsing on the first balance that does not reconcile.
+# - warn: log the offending page and line range and keep parsing.
+# - off: do not report the balances that do not reconcile.
+# In warn and off modes such balances are left out of the statement, which
+# ofxstatement would otherwise reject when writing the OFX file.
+BALANCE_CHECK_STRICT = "strict"
+BALANCE_CHECK_WARN = "warn"
+BALANCE_CHECK_OFF = "off"
+BALANCE_CHECK_MODES = (BALANCE_CHECK_STRICT, BALANCE_CHECK_WARN, BALANCE_CHECK_OFF)
+
+
+class BalanceMismatch(ParseError):
+    """Raised in strict mode when the balances do not reconcile. It is not
+    a malformed row: lenient mode does not quarantine it."""
+
+
+def balance_row_kind(description: str) -> Optional[str]:
+    """Return SALDO_INIZIALE or SALDO_FINALE if the description belongs to a balance row"""
+    text = description.replace("|", "").strip().upper()
+    if text.startswith(SALDO_INIZIALE):
+        return SALDO_INIZIALE
+    if text.startswith(SALDO_FINALE):
+        return SALDO_FINALE
+    return None
+
+
+class BalanceTracker:
+    """Keep a running balance while the statement is being parsed.
+
+    Every "Saldo iniziale" row (re)opens a segment and every "Saldo finale"
+    row closes it, checking that the opening balance plus the amounts parsed
+    in between matches the reported closing balance. The balances are
+    only published on the statement, by finish(), if they all reconcile.
+    """
+
+    def __init__(self, statement: Statement, mode: str = BALANCE_CHECK_WARN):
+        if mode not in BALANCE_CHECK_MODES:
+            raise ValueError(f"Invalid balance_check '{mode}', expected one of {', '.join(BALANCE_CHECK_MODES)}")
+        self.statement = statement
+        self.mode = mode
+        self.balance: Optional[Decimal] = None
+        self.mismatches = 0
+        self.reconciled = True
+        self._reset_segment()
+
+    def _reset_segment(self):
+        self.first_line = None
+        self.last_line = None
+        self.first_page = None
+        self.last_page = None
+
+    def _track(self, lineno, page):
+        if self.first_line is None:
+            self.first_line = lineno
+            self.first_page = page
+        self.last_line = lineno
+        self.last_page = page
+
+    def opening(self, balance: Decimal, date, lineno: int, page: Optional[int] = None):
+        self._track(lineno, page)
+        running = self.balance
+        self.balance = balance
+        if self.statement.start_balance is None:
+            self.statement.start_balance = balance
+            self.statement.start_date = date
+        elif running is not None:
+            # A new period must start where the previous one ended
+            self._verify(running, balance, SALDO_INIZIALE)
+        self._reset_segment()
+        self._track(lineno, page)
+
+    def add(self, amount: Decimal, lineno: int, page: Optional[int] = None):
+        self._track(lineno, page)
+        if self.balance is not None:
+            self.balance += amount
+
+    def skip(self, lineno: int, page: Optional[int] = None):
+        """A row that could not be parsed: the running balance is unknown
+        until the next opening balance"""
+        self._track(lineno, page)
+        self.balance = None
+
+    def closing(self, balance: Decimal, date, lineno: int, page: Optional[int] = None):
+        self._track(lineno, page)
+        running = self.balance
+        # Recorded even when the verification fails
+        self.statement.end_balance = balance
+        self.statement.end_date = date
+        self.balance = balance
+        if running is not None:
+            self._verify(running, balance, SALDO_FINALE)
+        self._reset_segment()
+
+    def _verify(self, running: Decimal, reported: Decimal, kind: str):
+        if running == reported:
+            return
+        self.reconciled = False
+        if self.mode == BALANCE_CHECK_OFF:
+            return
+
+        self.mismatches += 1
+        msg = "Running balance {0} does not match {1} {2} (difference {3}) {4}".format(
+            running, kind, reported, reported - running, self.location()
+        )
+        if self.mode == BALANCE_CHECK_STRICT:
+            raise BalanceMismatch(self.last_line, msg)
+        log.warning(msg)
+
+    def finish(self) -> None:
+        """Leave out of the statement the balances that do not reconcile"""
+        if not self.reconciled:
+            self.drop_balances("they do not reconcile with the transactions")
+
+    def drop_balances(self, reason: str) -> None:
+        if self.statement.start_balance is None and self.statement.end_balance is None:
+            return
+        (log.info if self.mode == BALANCE_CHECK_OFF else log.warning)(f"Statement balances left out: {reason}")
+        self.statement.start_balance = None
+        self.statement.end_balance = None
+
+    def location(self) -> str:
+        lines = f"lines {self.first_line}-{self.last_line}"
+        if self.first_page is None:
+            return f"at {lines}"
+        if self.first_page == self.last_page:
+            return f"on page {self.first_page}, {lines}"
+        return f"on pages {self.first_page}-{self.last_page}, {lines}"
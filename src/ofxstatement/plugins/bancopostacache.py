@@ -0,0 +1,48 @@
+import os
+import pickle
+import tempfile
+from typing import Any, Optional
+
+CACHE_DIR_NAME = "ofxstatement-bancoposta"
+
+
+def cache_dir(path: Optional[str] = None) -> str:
+    """Return (and create) the directory holding the plugin caches.
+
+    Defaults to $XDG_CACHE_HOME/ofxstatement-bancoposta.
+    """
+    if not path:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        path = os.path.join(base, CACHE_DIR_NAME)
+    path = os.path.expanduser(path)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def atomic_write(filename: str, data: bytes) -> None:
+    """Write data to filename so that readers never see a partial file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_pickle(filename: str) -> Optional[Any]:
+    """Load a cached object, ignoring missing or unreadable cache files"""
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+
+def store_pickle(filename: str, obj: Any) -> None:
+    try:
+        atomic_write(filename, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        # A read-only cache must never break the conversion
+        pass
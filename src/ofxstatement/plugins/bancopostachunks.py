@@ -0,0 +1,166 @@
+import csv
+import io
+import re
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ofxstatement.plugins.bancopostamemo import DescriptionMemo
+from ofxstatement.plugins.bancopostaquarantine import RowError
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+QUOTE = re.compile(rb'"')
+QUOTE_OR_NEWLINE = re.compile(rb'["\n]')
+FIELD_START = (b";", b"\n", b"\r")
+
+
+class QuoteState:
+    """Whether the scanned part of a CSV file ends inside a quoted field.
+
+    Quotes are read as the csv module reads them: a quote only opens a
+    field right after a delimiter or at the start of a record, so a bare
+    quote inside an unquoted field (MONITOR 27" 5) is a plain character,
+    and "" inside a quoted field is an escaped quote.
+    """
+
+    def __init__(self):
+        self.quoted = False
+        # Byte before the next block: scanning starts on a record boundary
+        self.previous = b"\n"
+        # Offset of the quote that closed the last quoted field
+        self.closed = -2
+
+    def scan(self, block: bytes, offset: int, find_end: bool = False) -> Optional[int]:
+        """Update the state with a block read at offset. With find_end, stop
+        at the first newline outside quotes and return the offset after it."""
+        for match in (QUOTE_OR_NEWLINE if find_end else QUOTE).finditer(block):
+            index = match.start()
+            position = offset + index
+            if match.group() == b"\n":
+                if not self.quoted:
+                    return position + 1
+            elif self.quoted:
+                self.quoted = False
+                self.closed = position
+            elif position == self.closed + 1 or (block[index - 1:index] if index else self.previous) in FIELD_START:
+                # "" reopens the field it closed
+                self.quoted = True
+        if block:
+            self.previous = block[-1:]
+        return None
+
+
+def next_line_start(f, offset: int, state: Optional[QuoteState] = None) -> Optional[int]:
+    """Return the start of the first record after offset, or None at the end
+    of file. state tells whether a quoted field is open at offset."""
+    state = state or QuoteState()
+    f.seek(offset)
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            return None
+        end = state.scan(block, offset, find_end=True)
+        if end is not None:
+            return end
+        offset += len(block)
+
+
+def record_boundary(f, start: int, target: int) -> Optional[int]:
+    """Return the first record boundary at or after target, scanning from
+    the record boundary start to know whether target is inside quotes"""
+    f.seek(start)
+    state = QuoteState()
+    position = start
+    while position < target:
+        block = f.read(min(BLOCK_SIZE, target - position))
+        if not block:
+            return None
+        state.scan(block, position)
+        position += len(block)
+    return next_line_start(f, target, state)
+
+
+def split_ranges(filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+    """Split a CSV file, header excluded, into byte ranges of about
+    chunk_size ending on record boundaries.
+
+    Newlines inside quoted fields do not end a record: every range is
+    scanned from its start following the quoting of its fields, so the
+    quoting state at the split point is always known.
+    """
+    with open(filename, "rb") as f:
+        size = f.seek(0, 2)
+        start = next_line_start(f, 0)
+        while start is not None and start < size:
+            end = record_boundary(f, start, start + chunk_size)
+            yield start, end if end is not None else size
+            start = end
+
+
+worker_parser = None
+
+
+def init_worker(columns: Dict[str, int], date_format: str, memo_size: int,
+                since: Optional[datetime], until: Optional[datetime]) -> None:
+    from ofxstatement.plugins.bancopostacsvparser import BancoPostaCSVStatementParser
+
+    global worker_parser
+    worker_parser = BancoPostaCSVStatementParser(io.StringIO())
+    worker_parser.columns = columns
+    worker_parser.date_format = date_format
+    worker_parser.memo = DescriptionMemo(memo_size) if memo_size else None
+    worker_parser.since = since
+    worker_parser.until = until
+
+
+def parse_chunk(filename: str, start: int, end: int, encoding: str) -> List[Optional[tuple]]:
+    """Parse the records of a byte range, in a worker process: one entry per
+    record, None for the records that are not statement rows and RowError
+    for the ones that fail"""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+
+    rows: List = []
+    for index, line in enumerate(csv.reader(io.StringIO(text, newline=""), delimiter=";"), 1):
+        worker_parser.cur_record = index
+        try:
+            rows.append(worker_parser.parse_row(line) if line else None)
+        except Exception as e:
+            # Raised or quarantined by the parser, which knows the line number
+            rows.append(RowError(e, line))
+    return rows
+
+
+def split_parsed_records(parser) -> Iterator:
+    """Parse a large CSV statement in chunks in a pool of worker processes.
+
+    Workers only classify rows and extract their fields; the rows are
+    yielded in file order, so balances, transaction ids and their
+    occurrence counters are computed by the parser exactly as when parsing
+    sequentially. At most two chunks per worker are in flight.
+    """
+    filename = parser.fin.name
+    encoding = parser.fin.encoding
+    memo_size = parser.memo.maxsize if parser.memo is not None else 0
+
+    # The header
+    yield None
+
+    executor = ProcessPoolExecutor(max_workers=parser.workers, initializer=init_worker,
+                                   initargs=(parser.columns, parser.date_format, memo_size, parser.since, parser.until))
+    try:
+        ranges = split_ranges(filename, parser.chunk_size)
+        futures = deque()
+        for start, end in ranges:
+            futures.append(executor.submit(parse_chunk, filename, start, end, encoding))
+            if len(futures) < parser.workers * 2:
+                continue
+            yield from futures.popleft().result()
+        while futures:
+            yield from futures.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
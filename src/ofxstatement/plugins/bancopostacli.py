@@ -0,0 +1,219 @@
+"""Command line tool for the BancoPosta features that go beyond `ofxstatement convert`"""
+
+import argparse
+import logging
+import sys
+from typing import List, Optional
+
+from ofxstatement import configuration, exceptions, ui
+from ofxstatement.plugins.bancoposta import BancoPostaPlugin
+
+log = logging.getLogger(__name__)
+
+
+def get_plugin(args: argparse.Namespace) -> BancoPostaPlugin:
+    """Create the plugin with the settings of the [type] section of the ofxstatement configuration"""
+    config = configuration.read(args.config)
+    if config is not None and args.type in config:
+        settings = dict(config[args.type])
+    elif args.type != "bancoposta":
+        raise exceptions.Abort("No section '%s' in config file." % args.type)
+    else:
+        settings = {}
+    # The command line overrides the window of the settings
+    for name in ("since", "until"):
+        if getattr(args, name, None):
+            settings[name] = getattr(args, name)
+    return BancoPostaPlugin(ui.UI(), settings)
+
+
+def parse_files(plugin: BancoPostaPlugin, filenames: List[str], sinks: List) -> int:
+    """Parse the files feeding every transaction to the sinks, returning the number of lines"""
+    total = 0
+    for filename in filenames:
+        parser = plugin.get_parser(filename)
+        parser.sinks.extend(sinks)
+        statement = parser.parse()
+        log.info("%s: %d lines" % (filename, len(statement.lines)))
+        total += len(statement.lines)
+    if plugin.memo is not None:
+        log.debug("Description memo: %s" % plugin.memo.stats())
+    if plugin.quarantine is not None and plugin.quarantine.errors:
+        log.warning("%d rows quarantined in %s" % (sum(plugin.quarantine.errors.values()), plugin.quarantine.filename))
+        plugin.quarantine.close()
+    return total
+
+
+def export(args: argparse.Namespace) -> int:
+    from ofxstatement.plugins.bancopostaarrow import ArrowExporter
+
+    plugin = get_plugin(args)
+    with ArrowExporter(args.output, batch_size=args.batch_size) as exporter:
+        total = parse_files(plugin, args.input, [exporter])
+    log.info("Export completed: %d lines written to %s" % (total, args.output))
+    return 0
+
+
+def convert(args: argparse.Namespace) -> int:
+    from ofxstatement.plugins.bancopostaoutput import CsvOutput, JsonOutput, OfxOutput, TeeOutput, field_mapping
+
+    plugin = get_plugin(args)
+    settings = plugin.settings
+    outputs = []
+    try:
+        if args.ofx:
+            outputs.append(OfxOutput(args.ofx, encoding=settings.get("encoding", "utf-8")))
+        if args.csv:
+            outputs.append(CsvOutput(args.csv, field_mapping(settings.get("csv_fields")), settings.get("csv_delimiter", ",")))
+        if args.json:
+            outputs.append(JsonOutput(args.json, field_mapping(settings.get("json_fields"))))
+    except ValueError as e:
+        raise exceptions.Abort(str(e))
+    if not outputs:
+        raise exceptions.Abort("No output: use --ofx, --csv and/or --json.")
+
+    parser = plugin.get_parser(args.input)
+    with TeeOutput(outputs) as tee:
+        parser.sinks.append(tee)
+        statement = parser.parse()
+        try:
+            statement.assert_valid()
+        except exceptions.ValidationError as e:
+            log.error("Statement validation error: %s" % e.message)
+            return 2
+        tee.finish(statement)
+    log.info("Conversion completed: %d lines written to %s" % (
+        len(statement.lines), ", ".join(output.filename for output in outputs)))
+    return 0
+
+
+def get_store(args: argparse.Namespace, plugin: BancoPostaPlugin):
+    from ofxstatement.plugins.bancopostastore import TransactionStore
+
+    if args.db:
+        return TransactionStore(args.db)
+    store = plugin.get_store()
+    if store is None:
+        raise exceptions.Abort("No transaction store: use --db or the 'store' setting.")
+    return store
+
+
+def store(args: argparse.Namespace) -> int:
+    plugin = get_plugin(args)
+    with get_store(args, plugin) as transaction_store:
+        # The plugin attaches its own store to the parsers
+        sinks = [transaction_store] if transaction_store is not plugin.store else []
+        total = parse_files(plugin, args.input, sinks)
+    log.info("Store completed: %d lines stored in %s" % (total, transaction_store.filename))
+    return 0
+
+
+def search(args: argparse.Namespace) -> int:
+    plugin = get_plugin(args)
+    with get_store(args, plugin) as transaction_store:
+        for record in transaction_store.search(" ".join(args.query), account_id=args.account,
+                                               since=args.since, until=args.until, limit=args.limit):
+            print("\t".join([
+                record["settlement_date"],
+                record["account_id"],
+                str(record["amount"]),
+                record["trntype"] or "",
+                record["payee"] or "",
+                record["memo"] or "",
+            ]))
+    return 0
+
+
+def watch(args: argparse.Namespace) -> int:
+    from ofxstatement.plugins.bancopostawatch import DirectoryWatcher
+
+    plugin = get_plugin(args)
+    watcher = DirectoryWatcher(args.directory, plugin.settings, output_dir=args.output,
+                               done_dir=args.done, failed_dir=args.failed, workers=args.workers,
+                               settle_time=args.settle, polling=args.poll)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    log.info("Watch stopped: %d converted, %d failed" % (watcher.converted, watcher.failed))
+    return 0
+
+
+def add_window_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--since", help="only parse transactions made on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="only parse transactions made on or before this date (YYYY-MM-DD)")
+
+
+def make_args_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="BancoPosta statement tools")
+    parser.add_argument("-d", "--debug", action="store_true", default=False, help="show debugging information")
+    parser.add_argument("-c", "--config", help="ofxstatement configuration file (default: the ofxstatement one)")
+    parser.add_argument("-t", "--type", default="bancoposta", help="configuration section to read the plugin settings from")
+
+    subparsers = parser.add_subparsers(title="action")
+
+    parser_convert = subparsers.add_parser("convert", help="convert a statement to OFX, CSV and JSON in a single parse")
+    parser_convert.add_argument("--ofx", help="OFX output file")
+    parser_convert.add_argument("--csv", help="CSV output file (fields: 'csv_fields' setting)")
+    parser_convert.add_argument("--json", help="JSON output file (fields: 'json_fields' setting)")
+    add_window_arguments(parser_convert)
+    parser_convert.add_argument("input", help="input statement file")
+    parser_convert.set_defaults(func=convert)
+
+    parser_export = subparsers.add_parser("export", help="export transactions to Parquet or Arrow")
+    parser_export.add_argument("-o", "--output", required=True, help="output file: .parquet, or .arrow for an Arrow IPC stream")
+    parser_export.add_argument("--batch-size", type=int, default=65536, help="rows per record batch")
+    add_window_arguments(parser_export)
+    parser_export.add_argument("input", nargs="+", help="input statement files")
+    parser_export.set_defaults(func=export)
+
+    parser_store = subparsers.add_parser("store", help="add transactions to the local transaction store")
+    parser_store.add_argument("--db", help="SQLite store (default: the 'store' setting)")
+    add_window_arguments(parser_store)
+    parser_store.add_argument("input", nargs="+", help="input statement files")
+    parser_store.set_defaults(func=store)
+
+    parser_search = subparsers.add_parser("search", help="full-text search of the local transaction store")
+    parser_search.add_argument("--db", help="SQLite store (default: the 'store' setting)")
+    parser_search.add_argument("--account", help="only transactions of this account")
+    parser_search.add_argument("--since", help="only transactions settled on or after this date (YYYY-MM-DD)")
+    parser_search.add_argument("--until", help="only transactions settled on or before this date (YYYY-MM-DD)")
+    parser_search.add_argument("--limit", type=int, default=100, help="maximum number of results (0 for all)")
+    parser_search.add_argument("query", nargs="*", help="words to look for in payee, reason and description")
+    parser_search.set_defaults(func=search)
+
+    parser_watch = subparsers.add_parser("watch", help="convert the statements dropped in a directory to OFX")
+    parser_watch.add_argument("-o", "--output", help="directory of the OFX files (default: the watched directory)")
+    parser_watch.add_argument("--done", help="where converted statements are moved (default: DIRECTORY/done)")
+    parser_watch.add_argument("--failed", help="where statements that fail are moved (default: DIRECTORY/failed)")
+    parser_watch.add_argument("--workers", type=int, default=2, help="number of parallel conversions")
+    parser_watch.add_argument("--settle", type=float, default=1.0, help="seconds a file must stay unchanged before it is converted")
+    parser_watch.add_argument("--poll", action="store_true", default=False, help="poll the directory instead of using inotify")
+    add_window_arguments(parser_watch)
+    parser_watch.add_argument("directory", help="directory to watch")
+    parser_watch.set_defaults(func=watch)
+
+    return parser
+
+
+def run(argv: Optional[List[str]] = None) -> int:
+    parser = make_args_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not hasattr(args, "func"):
+        parser.print_usage()
+        return 1
+
+    try:
+        return args.func(args)
+    except exceptions.Abort as e:
+        log.error(str(e))
+        return 1
+    except exceptions.ParseError as e:
+        log.error("Parse error on line %s: %s" % (e.lineno, e.message))
+        return 2
+
+
+def main() -> None:
+    sys.exit(run())
@@ -1,23 +1,38 @@
 from typing import Optional, Any, List
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 import csv
+import os
 
-from ofxstatement.plugins.bancopostapdfparser import DESCRIPTION_TYPE_MAP
+from ofxstatement.exceptions import ParseError
 from ofxstatement.parser import CsvStatementParser
 from ofxstatement.statement import StatementLine, Currency, Statement
-from ofxstatement.plugins.bancopostaTransaction import DebitTransaction, CreditTransaction
+from ofxstatement.plugins.bancopostabalance import balance_row_kind
+from ofxstatement.plugins.bancopostachunks import DEFAULT_CHUNK_SIZE, split_parsed_records
+from ofxstatement.plugins.bancopostaparser import BancoPostaStatementParserMixin
+from ofxstatement.plugins.bancopostaquarantine import RowError, quarantined
 
 
-class BancoPostaCSVStatementParser(CsvStatementParser):
+class BancoPostaCSVStatementParser(BancoPostaStatementParserMixin, CsvStatementParser):
     __slots__ = 'columns'
 
     date_format = "%d/%m/%y"
+    # Processes parsing chunks of large files in parallel
+    workers = 1
+    chunk_size = DEFAULT_CHUNK_SIZE
+    chunk_records = None
 
     def parse_currency(self, value: Optional[str], field: str) -> Currency:
         return Currency(symbol=value)
 
     def parse_amount(self, value: [Optional[str]]) -> Decimal:
-        return Decimal(value.replace(" ", "").replace(".", "").replace(",", "."))
+        try:
+            return Decimal(value.replace(" ", "").replace(".", "").replace(",", "."))
+        except InvalidOperation:
+            raise ParseError(self.cur_record, "Invalid amount %r" % value)
+
+    def parse_balance(self, value: Optional[str]) -> Decimal:
+        value = value.replace("|", "").strip() if value else value
+        return self.parse_amount(value) if value else Decimal(0)
 
     def parse_value(self, value: Optional[str], field: str) -> Any:
         value = value.strip() if value else value
@@ -33,30 +48,41 @@ class BancoPostaCSVStatementParser(CsvStatementParser):
         return super().parse_value(value, field)
     
     def split_records(self):
+        if self.workers > 1 and os.path.getsize(self.fin.name) > self.chunk_size:
+            self.chunk_records = split_parsed_records(self)
+            return self.chunk_records
         return csv.reader(self.fin, delimiter=';')
     
-    def create_transaction(self, text, date, settlement_date, amount, currency):
-        for key, value in DESCRIPTION_TYPE_MAP.items():
-            if text.startswith(key):
-                return value(date, settlement_date, amount, text, currency)
-        
-        if amount > 0:
-            return CreditTransaction(date, settlement_date, amount, text, currency)
-        else:
-            return DebitTransaction(date, settlement_date, amount, text, currency)
+    @quarantined
+    def parse_record(self, line) -> Optional[StatementLine]:
+        if self.workers > 1 and isinstance(line, tuple):
+            # Already parsed by a chunk worker
+            return self.record_row(line)
+        if self.workers > 1 and isinstance(line, RowError):
+            raise line.exception(self.cur_record)
 
-        return None
-
-    def parse_record(self, line: List[str]) -> Optional[StatementLine]:
         # Ignore the header
         if self.cur_record <= 1:
             return None
 
+        row = self.parse_row(line)
+        return self.record_row(row) if row else None
+
+    def parse_row(self, line: List[str]) -> Optional[tuple]:
+        """Parse a row without touching the statement, returning
+        (kind, date, balance) for balance rows or (transaction, in_window)
+        otherwise: transactions out of the window still count for the ids"""
         c = self.columns
 
-        # Ignore Saldo iniziale/finale
+        # Saldo iniziale/finale only update the balances
         settlementDateString = line[c["Valuta"]].strip()
-        if settlementDateString == "" or settlementDateString == "Valuta":
+        if settlementDateString == "":
+            kind = balance_row_kind(line[c["Descrizione operazioni"]])
+            if kind:
+                balance = self.parse_balance(line[c["Accrediti"]]) - self.parse_balance(line[c["Addebiti"]])
+                return (kind, self.parse_value(line[c["Data"]], "date"), balance)
+            return None
+        if settlementDateString == "Valuta":
             return None
 
         date = self.parse_value(line[c["Data"]], "date")
@@ -68,13 +94,26 @@ class BancoPostaCSVStatementParser(CsvStatementParser):
         elif line[c["Addebiti"]]:
             outcome = self.parse_amount(line[c["Addebiti"]])
             income = 0
+        else:
+            raise ParseError(self.cur_record, "Neither Addebiti nor Accrediti is set")
         amount = income - outcome
         currency = self.parse_value("EUR", "currency")
 
         description = line[c["Descrizione operazioni"]]
         
-        transaction = self.create_transaction(description, date, settlementDate, amount, currency)
-        stmt_line = transaction.to_statement_line()
+        return (self.create_transaction(description, date, settlementDate, amount, currency), self.in_window(date))
+
+    def record_row(self, row: tuple) -> Optional[StatementLine]:
+        """Add a parsed row to the statement, in file order"""
+        if len(row) == 3:
+            self.record_balance(*row)
+            return None
+
+        transaction, in_window = row
+        if not in_window:
+            self.id_generator.skip(transaction)
+            return None
+        stmt_line = self.record_transaction(transaction)
 
         stmt_line.currency = self.parse_value("EUR", "currency")
 
@@ -82,5 +121,12 @@ class BancoPostaCSVStatementParser(CsvStatementParser):
 
     # noinspection PyUnresolvedReferences
     def parse(self) -> Statement:
-        statement = super().parse()
+        try:
+            statement = super().parse()
+        finally:
+            # Shut the chunk workers down now, even when parsing fails,
+            # rather than whenever the generator is collected
+            if self.chunk_records is not None:
+                self.chunk_records.close()
+                self.chunk_records = None
         return statement
\ No newline at end of file
@@ -0,0 +1,67 @@
+import hashlib
+import re
+from typing import Dict, Optional
+
+REFERENCE_PATTERNS = [
+    re.compile(r"\bTRN\s+(\S+)"),
+    re.compile(r"\bCID\.?\s*(\S+)"),
+]
+
+
+def hash_64(data: bytes) -> str:
+    """64 bit BLAKE2b hash in hex: computed in C and stable across runs"""
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def extract_reference(description: str) -> Optional[str]:
+    """Return the TRN or CID code of the description, if any"""
+    for pattern in REFERENCE_PATTERNS:
+        match = pattern.search(description)
+        if match:
+            return match.group(1)
+    return None
+
+
+def transaction_key(transaction) -> str:
+    """Normalized key of a transaction.
+
+    Only fields that are identical in the PDF and the CSV statement are used,
+    so that the same transaction gets the same id from both sources.
+    """
+    return "|".join([
+        transaction.settlement_date.strftime("%Y%m%d"),
+        str(int(transaction.amount * 100)),
+        transaction.type.name,
+        transaction.reference or "",
+    ])
+
+
+def generate_id(key: str, occurrence: int = 0) -> str:
+    transaction_id = hash_64(key.encode("utf8"))
+    if occurrence:
+        transaction_id += "-%d" % occurrence
+    return transaction_id
+
+
+class TransactionIdGenerator:
+    """Generate deterministic transaction ids for a statement.
+
+    Transactions sharing the same key (e.g. two identical commissions on the
+    same day) are told apart by their occurrence number in the statement.
+    Every transaction of the statement counts, including the skipped ones.
+    """
+
+    def __init__(self):
+        self.occurrences: Dict[str, int] = {}
+
+    def generate(self, transaction) -> str:
+        key = transaction_key(transaction)
+        occurrence = self.occurrences.get(key, 0)
+        self.occurrences[key] = occurrence + 1
+        return generate_id(key, occurrence)
+
+    def skip(self, transaction) -> None:
+        """Count a transaction left out of the output (e.g. by the since/until
+        window), so that the next ones get the same ids as in a full parse"""
+        key = transaction_key(transaction)
+        self.occurrences[key] = self.occurrences.get(key, 0) + 1
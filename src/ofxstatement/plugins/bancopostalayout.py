@@ -0,0 +1,153 @@
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from ofxstatement.plugins.bancopostacache import cache_dir, load_pickle, store_pickle
+from ofxstatement.plugins.bancopostaid import hash_64
+
+log = logging.getLogger(__name__)
+
+# Bump when the detection changes, to invalidate old caches
+LAYOUT_CACHE_VERSION = 2
+
+# Areas (top, left, bottom, right) in points of the original A4 template,
+# used whenever the table header cannot be found.
+DEFAULT_FIRST_PAGE_AREA = (284.637, 13.462, 731.112, 586.438)
+DEFAULT_PAGE_AREA = (106.797, 11.974, 772.045, 586.438)
+A4_HEIGHT = 841.89
+
+HEADER_WORDS = ("Data", "Valuta", "Addebiti", "Accrediti", "Descrizione")
+
+# Distance kept between the header baseline and the area borders
+HEADER_MARGIN = 12.0
+SIDE_MARGIN = 8.5
+
+Area = Tuple[float, float, float, float]
+
+
+def page_role(page_number: int) -> str:
+    return "first" if page_number == 1 else "other"
+
+
+def default_area(page_number: int) -> Area:
+    return DEFAULT_FIRST_PAGE_AREA if page_number == 1 else DEFAULT_PAGE_AREA
+
+
+def layout_fingerprint(reader, page_number: int) -> str:
+    """Identify the template of a page by producer, page size and position in the document"""
+    page = reader.pages[page_number - 1]
+    metadata = reader.metadata or {}
+    return "|".join([
+        str(metadata.get("/Producer", "")),
+        str(metadata.get("/Creator", "")),
+        "%.0fx%.0f" % (float(page.mediabox.width), float(page.mediabox.height)),
+        str(page.get("/Rotate", 0)),
+        page_role(page_number),
+    ])
+
+
+def find_header(page) -> Optional[Dict[str, Tuple[float, float]]]:
+    """Return the (x, y) position of the table header words of a page"""
+    # Every text starting with a header word: "Data di emissione" above
+    # the table must not hide the Data of the header
+    candidates: List[Tuple[str, float, float]] = []
+
+    def visitor(text, cm, tm, font_dict, font_size):
+        # Text space to user space: tm x cm
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        for word in HEADER_WORDS:
+            if text.strip().startswith(word):
+                candidates.append((word, x, y))
+
+    page.extract_text(visitor_text=visitor)
+
+    # The header is the first row where all the header words line up
+    for _, _, header_y in candidates:
+        row: Dict[str, Tuple[float, float]] = {}
+        for word, x, y in candidates:
+            if abs(y - header_y) < HEADER_MARGIN / 2:
+                row.setdefault(word, (x, y))
+        if all(word in row for word in HEADER_WORDS):
+            return row
+    return None
+
+
+def header_in_area(header: Dict[str, Tuple[float, float]], area: Area, height: float) -> bool:
+    """Check that a table header opens the area, as it did when the area was detected"""
+    top, left, bottom, right = area
+    header_top = height - max(y for x, y in header.values())
+    header_left = min(x for x, y in header.values())
+    return top <= header_top <= top + 2 * HEADER_MARGIN and left <= header_left <= right
+
+
+def detect_area(page, page_number: int, header: Optional[Dict[str, Tuple[float, float]]] = None) -> Optional[Area]:
+    """Compute the tabula area of the transactions table from its header"""
+    if header is None:
+        header = find_header(page)
+    if not header:
+        return None
+
+    width = float(page.mediabox.width)
+    height = float(page.mediabox.height)
+    default = default_area(page_number)
+
+    header_y = max(y for x, y in header.values())
+    left = min(x for x, y in header.values())
+    top = height - header_y - HEADER_MARGIN
+    bottom = height * default[2] / A4_HEIGHT
+    if top >= bottom:
+        return None
+    return (round(top, 3), round(max(left - SIDE_MARGIN, 0), 3), round(bottom, 3), round(width - SIDE_MARGIN, 3))
+
+
+class LayoutDetector:
+    """Find the table area of statement pages, once per layout.
+
+    Detected areas are kept in memory and on disk keyed by the layout
+    fingerprint, so later statements of the same template skip detection.
+    The fingerprint cannot tell a moved table apart, so in every statement
+    the first page of each layout is checked: a known area is only reused
+    if the header of the page still opens it; otherwise the layout is
+    detected again and the cache replaced.
+    """
+
+    def __init__(self, cache_path: Optional[str] = None):
+        self.cache_path = cache_path
+        self.areas: Dict[str, Area] = {}
+        # The statement being read and the layouts already checked in it
+        self.reader = None
+        self.checked: Set[str] = set()
+
+    def cache_file(self, fingerprint: str) -> str:
+        key = hash_64(fingerprint.encode("utf8"))
+        return os.path.join(cache_dir(self.cache_path), f"layout-{LAYOUT_CACHE_VERSION}-{key}.pickle")
+
+    def area(self, reader, page_number: int) -> Area:
+        if reader is not self.reader:
+            # A detector is shared by all the files of a run
+            self.reader = reader
+            self.checked = set()
+        fingerprint = layout_fingerprint(reader, page_number)
+        area = self.areas.get(fingerprint)
+        if area is not None and fingerprint in self.checked:
+            return area
+
+        page = reader.pages[page_number - 1]
+        header = find_header(page)
+        cache_file = self.cache_file(fingerprint)
+        if area is None:
+            area = load_pickle(cache_file)
+        if area is not None and header and not header_in_area(header, area, float(page.mediabox.height)):
+            log.info(f"Table header of page {page_number} is outside the known area, detecting the layout again")
+            area = None
+        if area is None:
+            area = detect_area(page, page_number, header)
+            if area is None:
+                log.info(f"Table header not found on page {page_number}, using the default area")
+                return default_area(page_number)
+            store_pickle(cache_file, area)
+
+        self.areas[fingerprint] = area
+        self.checked.add(fingerprint)
+        return area
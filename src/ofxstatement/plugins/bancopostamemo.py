@@ -0,0 +1,50 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+DEFAULT_MEMO_SIZE = 8192
+
+
+def normalize_description(description: str) -> str:
+    """Collapse the whitespace differences between statements of the same transaction"""
+    return " ".join(description.split())
+
+
+class DescriptionMemo:
+    """Bounded LRU cache of the classification and extraction of descriptions.
+
+    Statements repeat the same descriptions over and over (monthly direct
+    debits, stamp duties, commissions): one memo shared by all the parsers of
+    a batch run lets every description be classified and sliced only once.
+    Cached strings are interned, so repeated payees are stored once.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MEMO_SIZE):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Hashable, Tuple[type, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[type, Dict[str, Any]]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, cls: type, info: Dict[str, Any]) -> None:
+        info = {name: sys.intern(value) if isinstance(value, str) else value for name, value in info.items()}
+        self.entries[key] = (cls, info)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.0%}), {len(self.entries)}/{self.maxsize} entries"
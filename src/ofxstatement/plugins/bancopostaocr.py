@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from ofxstatement.plugins.bancopostacache import cache_dir, load_pickle, store_pickle
+
+log = logging.getLogger(__name__)
+
+# Bump when the OCR output changes, to invalidate old caches
+OCR_CACHE_VERSION = 1
+
+OCR_AUTO = "auto"
+OCR_OFF = "off"
+
+DEFAULT_OCR_LANG = "ita"
+DEFAULT_OCR_DPI = 300
+
+# Start of the five columns as a fraction of the table width in the
+# standard template, used when the header is not recognized
+DEFAULT_COLUMN_FRACTIONS = (0.0, 0.11, 0.22, 0.34, 0.46)
+HEADER_WORDS = ("Data", "Valuta", "Addebiti", "Accrediti", "Descrizione")
+
+Area = Tuple[float, float, float, float]
+Word = Tuple[float, float, float, float, str]
+
+
+def page_has_text(page) -> bool:
+    """Scanned pages carry images only: their text layer is empty. Fonts
+    are not a hint, they may be in the resources of Form XObjects."""
+    return bool((page.extract_text() or "").strip())
+
+
+def page_content_hash(page) -> str:
+    """Hash of what is drawn on a page: its content stream and images"""
+    h = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        h.update(contents.get_data())
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources is not None else None
+    if xobjects:
+        for name in sorted(xobjects.get_object()):
+            h.update(name.encode("utf8"))
+            h.update(xobjects.get_object()[name].get_object().get_data())
+    return h.hexdigest()
+
+
+def parse_tsv(tsv: str) -> List[Word]:
+    """Return (left, top, width, height, text) of the words of a tesseract TSV output"""
+    words = []
+    lines = tsv.splitlines()
+    for line in lines[1:]:
+        fields = line.split("\t")
+        if len(fields) < 12 or fields[0] != "5" or not fields[11].strip():
+            continue
+        left, top, width, height = (float(value) for value in fields[6:10])
+        words.append((left, top, width, height, fields[11].strip()))
+    return words
+
+
+def group_lines(words: List[Word]) -> List[List[Word]]:
+    """Cluster the words into text lines by their vertical position"""
+    lines: List[List[Word]] = []
+    for word in sorted(words, key=lambda w: w[1] + w[3] / 2):
+        center = word[1] + word[3] / 2
+        if lines:
+            last = lines[-1]
+            last_center = sum(w[1] + w[3] / 2 for w in last) / len(last)
+            if abs(center - last_center) < max(w[3] for w in last) * 0.6:
+                last.append(word)
+                continue
+        lines.append([word])
+    return [sorted(line, key=lambda w: w[0]) for line in lines]
+
+
+def words_to_rows(words: List[Word], width: float) -> List[List[str]]:
+    """Map the recognized words into the Data, Valuta, Addebiti, Accrediti,
+    Descrizione operazioni columns, the same rows tabula would produce"""
+    lines = group_lines(words)
+
+    starts = [width * fraction for fraction in DEFAULT_COLUMN_FRACTIONS]
+    header = -1
+    for index, line in enumerate(lines):
+        texts = {w[4]: w[0] for w in line}
+        if all(word in texts for word in HEADER_WORDS):
+            starts = [texts[word] for word in HEADER_WORDS]
+            header = index
+            break
+
+    rows = []
+    for line in lines[header + 1:]:
+        cells: List[List[str]] = [[] for _ in starts]
+        for left, top, w, h, text in line:
+            center = left + w / 2
+            column = max((i for i, start in enumerate(starts) if start <= center), default=0)
+            cells[column].append(text)
+        rows.append([" ".join(cell) if cell else "nan" for cell in cells])
+    return rows
+
+
+def ocr_page(filename: str, page_number: int, area: Area, dpi: int, lang: str) -> List[List[str]]:
+    """Rasterize the table area of a page and OCR it"""
+    top, left, bottom, right = area
+    scale = dpi / 72
+    x, y = int(left * scale), int(top * scale)
+    w, h = int((right - left) * scale), int((bottom - top) * scale)
+
+    image = subprocess.run(
+        ["pdftoppm", "-f", str(page_number), "-l", str(page_number), "-r", str(dpi),
+         "-x", str(x), "-y", str(y), "-W", str(w), "-H", str(h), "-gray", "-png", filename],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout
+
+    # Parallelism comes from the pool: keep each tesseract single threaded
+    env = dict(os.environ, OMP_THREAD_LIMIT="1")
+    tsv = subprocess.run(
+        ["tesseract", "stdin", "stdout", "-l", lang, "--psm", "6", "tsv"],
+        input=image, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+    ).stdout.decode("utf8")
+
+    return words_to_rows(parse_tsv(tsv), w)
+
+
+class OcrExtractor:
+    """Extract the table of scanned pages with the locally installed
+    poppler (pdftoppm) and tesseract.
+
+    Pages are OCRed in parallel in a process pool and the result of every
+    page is cached by the hash of the page content, as OCR is by far the
+    most expensive step of the conversion.
+    """
+
+    def __init__(self, lang: str = DEFAULT_OCR_LANG, dpi: int = DEFAULT_OCR_DPI,
+                 workers: Optional[int] = None, cache_path: Optional[str] = None):
+        self.lang = lang
+        self.dpi = dpi
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_path = cache_path
+
+    @staticmethod
+    def available() -> bool:
+        return bool(shutil.which("pdftoppm") and shutil.which("tesseract"))
+
+    def cache_file(self, page, area: Area) -> str:
+        key = hashlib.sha256(f"{page_content_hash(page)}|{area}|{self.dpi}|{self.lang}".encode("utf8")).hexdigest()
+        return os.path.join(cache_dir(self.cache_path), f"ocr-{OCR_CACHE_VERSION}-{key}.pickle")
+
+    def extract(self, filename: str, reader, areas: Dict[int, Area]) -> Iterator[Tuple[int, List[List[str]]]]:
+        """Yield (page number, rows) for the given pages, in page order.
+
+        Cached pages are only loaded when their turn comes and at most two
+        pages per worker are OCRed ahead of the one being yielded, so memory
+        stays bounded whatever the number of scanned pages.
+        """
+        pages = iter(sorted(areas))
+        window: Deque[Tuple[int, str, Optional[Future]]] = deque()
+        executor = None
+        ocred = 0
+        try:
+            while True:
+                for page in islice(pages, self.workers * 2 - len(window)):
+                    cache_file = self.cache_file(reader.pages[page - 1], areas[page])
+                    future = None
+                    if self.workers > 1 and not os.path.exists(cache_file):
+                        if executor is None:
+                            executor = ProcessPoolExecutor(max_workers=self.workers)
+                        future = executor.submit(ocr_page, filename, page, areas[page], self.dpi, self.lang)
+                    window.append((page, cache_file, future))
+                if not window:
+                    break
+
+                page, cache_file, future = window.popleft()
+                rows = load_pickle(cache_file) if future is None else None
+                if rows is None:
+                    rows = future.result() if future is not None else ocr_page(filename, page, areas[page], self.dpi, self.lang)
+                    store_pickle(cache_file, rows)
+                    ocred += 1
+                yield page, rows
+                # Do not hold on to this page while waiting for the next one
+                rows = future = None
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        if ocred:
+            log.info(f"OCR of {ocred} scanned pages")
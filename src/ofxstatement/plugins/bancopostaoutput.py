@@ -0,0 +1,251 @@
+import csv
+import json
+import os
+import queue
+import tempfile
+import threading
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from ofxstatement import ofx
+from ofxstatement.statement import Statement
+
+BUFFER_SIZE = 1024 * 1024
+DEFAULT_BATCH_SIZE = 1024
+
+# Fields of BancoPostaTransaction.to_record, plus the account
+FIELDS = [
+    "id", "account_id", "date", "settlement_date", "amount", "currency", "trntype",
+    "payee", "reason", "memo", "reference", "operation", "card", "category",
+]
+
+
+def field_mapping(spec: Optional[str]) -> Dict[str, str]:
+    """Parse a field list such as "settlement_date, amount, Beneficiario=payee"
+    into a mapping of output names to record fields"""
+    if not spec:
+        return {field: field for field in FIELDS}
+    mapping = {}
+    for item in spec.split(","):
+        name, _, field = item.strip().partition("=")
+        field = field.strip() or name.strip()
+        if field not in FIELDS:
+            raise ValueError("Unknown field %r, expected one of %s" % (field, ", ".join(FIELDS)))
+        mapping[name.strip()] = field
+    return mapping
+
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class AtomicFile:
+    """Buffered file written under a temporary name in the same directory
+    and renamed over the target only once it is complete"""
+
+    def __init__(self, filename: str, encoding: str = "utf-8", newline: Optional[str] = None):
+        self.filename = filename
+        directory, name = os.path.split(os.path.abspath(filename))
+        fd, self.temp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        self.file = os.fdopen(fd, "w", encoding=encoding, newline=newline, buffering=BUFFER_SIZE)
+
+    def write(self, text: str) -> None:
+        self.file.write(text)
+
+    def commit(self) -> None:
+        self.file.close()
+        os.replace(self.temp, self.filename)
+
+    def discard(self) -> None:
+        self.file.close()
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+
+
+class CsvOutput:
+    """Normalized CSV: one row per transaction, with a header"""
+
+    def __init__(self, filename: str, fields: Optional[Dict[str, str]] = None, delimiter: str = ","):
+        self.filename = filename
+        self.fields = fields or field_mapping(None)
+        self.delimiter = delimiter
+
+    def open(self) -> None:
+        self.file = AtomicFile(self.filename, newline="")
+        self.writer = csv.writer(self.file, delimiter=self.delimiter)
+        self.writer.writerow(list(self.fields))
+
+    def write(self, records: List[Dict]) -> None:
+        fields = list(self.fields.values())
+        self.writer.writerows([format_value(record[field]) for field in fields] for record in records)
+
+    def finish(self, statement: Statement) -> None:
+        self.file.commit()
+
+    def discard(self) -> None:
+        self.file.discard()
+
+
+class JsonOutput:
+    """JSON document with the transactions followed by the statement balances
+    and dates, streamed without keeping the transactions in memory"""
+
+    def __init__(self, filename: str, fields: Optional[Dict[str, str]] = None):
+        self.filename = filename
+        self.fields = fields or field_mapping(None)
+
+    def open(self) -> None:
+        self.file = AtomicFile(self.filename)
+        self.file.write('{\n"transactions": [')
+        self.separator = "\n"
+
+    def write(self, records: List[Dict]) -> None:
+        fields = self.fields.items()
+        for record in records:
+            self.file.write(self.separator)
+            self.file.write(json.dumps({name: format_value(record[field]) for name, field in fields}, ensure_ascii=False))
+            self.separator = ",\n"
+
+    def finish(self, statement: Statement) -> None:
+        summary = {
+            "bank_id": statement.bank_id,
+            "account_id": statement.account_id,
+            "currency": statement.currency,
+            "start_date": format_value(statement.start_date),
+            "start_balance": format_value(statement.start_balance),
+            "end_date": format_value(statement.end_date),
+            "end_balance": format_value(statement.end_balance),
+        }
+        self.file.write("\n],\n")
+        self.file.write(",\n".join("%s: %s" % (json.dumps(name), json.dumps(value, ensure_ascii=False)) for name, value in summary.items()))
+        self.file.write("\n}\n")
+        self.file.commit()
+
+    def discard(self) -> None:
+        self.file.discard()
+
+
+class OfxOutput:
+    """OFX for GnuCash, written from the parsed statement"""
+
+    def __init__(self, filename: str, encoding: str = "utf-8", pretty: bool = True):
+        self.filename = filename
+        self.encoding = encoding
+        self.pretty = pretty
+
+    def open(self) -> None:
+        self.file = AtomicFile(self.filename, encoding=self.encoding)
+
+    def write(self, records: List[Dict]) -> None:
+        # The OFX header needs the balances of the whole statement
+        pass
+
+    def finish(self, statement: Statement) -> None:
+        self.file.write(ofx.OfxWriter(statement).toxml(pretty=self.pretty, encoding=self.encoding))
+        self.file.commit()
+
+    def discard(self) -> None:
+        self.file.discard()
+
+
+FINISH = "finish"
+ABORT = "abort"
+
+
+class TeeOutput:
+    """Write the transactions of one parse to several formats at once.
+
+    It is a parser sink: every transaction is turned into a record once and
+    handed, in batches, to one thread per output format, which serializes it
+    to a buffered temporary file. finish() completes the outputs with the
+    parsed statement and renames them into place; if anything fails, no
+    output file is left behind.
+    """
+
+    def __init__(self, outputs: List, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.outputs = outputs
+        self.batch_size = batch_size
+        self.batch: List[Dict] = []
+        self.errors: List[Exception] = []
+        self.done = False
+        self.queues = [queue.Queue(maxsize=16) for _ in outputs]
+        self.threads = [
+            threading.Thread(target=self.run, args=(output, q), daemon=True)
+            for output, q in zip(outputs, self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, output, q: queue.Queue) -> None:
+        try:
+            output.open()
+        except Exception as e:
+            self.errors.append(e)
+            output = None
+        while True:
+            kind, item = q.get()
+            if output is None:
+                # Failed: keep consuming so that the parser never blocks
+                if kind != "records":
+                    return
+                continue
+            try:
+                if kind == "records":
+                    output.write(item)
+                elif kind == FINISH and not self.errors:
+                    output.finish(item)
+                    return
+                else:
+                    output.discard()
+                    return
+            except Exception as e:
+                self.errors.append(e)
+                output.discard()
+                output = None
+                if kind != "records":
+                    return
+
+    def add_line(self, statement, transaction, stmt_line) -> None:
+        record = transaction.to_record(stmt_line)
+        record["account_id"] = statement.account_id
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.dispatch()
+
+    def dispatch(self) -> None:
+        if self.batch:
+            for q in self.queues:
+                q.put(("records", self.batch))
+            self.batch = []
+
+    def close(self, kind: str, statement: Optional[Statement] = None) -> None:
+        if self.done:
+            return
+        self.done = True
+        self.dispatch()
+        for q in self.queues:
+            q.put((kind, statement))
+        for thread in self.threads:
+            thread.join()
+
+    def finish(self, statement: Statement) -> None:
+        """Complete every output with the statement and move them into place"""
+        self.close(FINISH, statement)
+        if self.errors:
+            raise self.errors[0]
+
+    def abort(self) -> None:
+        """Remove the partial outputs"""
+        self.close(ABORT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Outputs that were not finished are discarded
+        self.abort()
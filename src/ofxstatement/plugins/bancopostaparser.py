@@ -0,0 +1,146 @@
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from ofxstatement.exceptions import ParseError
+from ofxstatement.statement import Statement, StatementLine
+from ofxstatement.plugins.bancopostabalance import BalanceTracker, BALANCE_CHECK_WARN, SALDO_INIZIALE
+from ofxstatement.plugins.bancopostaid import TransactionIdGenerator
+from ofxstatement.plugins.bancopostamemo import DescriptionMemo, normalize_description
+from ofxstatement.plugins.bancopostaquarantine import ON_ERROR_STRICT, Quarantine, RowError
+from ofxstatement.plugins.bancopostarules import CompiledRules
+from ofxstatement.plugins.bancopostaTransaction import DebitTransaction, CreditTransaction, ATMTransaction, AddebitoDirettoTransaction, AddebitoPreautorizzatoTransaction, BolloTransaction, BonificoTransaction, CommissioneTransaction, PagamentoPostamatTransaction, PostagiroTransaction
+
+log = logging.getLogger(__name__)
+
+DESCRIPTION_TYPE_MAP = {
+    "BONIFICO": BonificoTransaction,
+    "VOSTRA DISPOS. DI BONIFICO": BonificoTransaction,
+    "POSTAGIRO": PostagiroTransaction,
+    "IMPOSTA DI BOLLO": BolloTransaction,
+    "COMMISSIONE": CommissioneTransaction,
+    "PAGAMENTO POSTAMAT": PagamentoPostamatTransaction,
+    "VERSAMENTO": ATMTransaction,
+    "PRELIEVO": ATMTransaction,
+    "ADDEBITO DIRETTO": AddebitoDirettoTransaction,
+    "ADDEBITO PREAUTORIZZATO": AddebitoPreautorizzatoTransaction
+}
+
+
+class BancoPostaStatementParserMixin:
+    """Behaviour shared by the BancoPosta CSV and PDF parsers"""
+
+    balance_check = BALANCE_CHECK_WARN
+    balance_tracker: Optional[BalanceTracker] = None
+    id_generator: Optional[TransactionIdGenerator] = None
+    rules: Optional[CompiledRules] = None
+    memo: Optional[DescriptionMemo] = None
+    on_error = ON_ERROR_STRICT
+    quarantine: Optional[Quarantine] = None
+    # Only the transactions whose operation date (Data) is in this window
+    # are parsed: statements are in order of operation date, not of settlement
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Objects receiving every transaction as soon as it is parsed,
+        # through add_line(statement, transaction, stmt_line), and
+        # optionally the whole statement through end_statement(statement)
+        self.sinks: List = []
+        # Number of quarantined rows by error type
+        self.errors: Counter = Counter()
+
+    def create_transaction(self, text, date, settlement_date, amount, currency):
+        if self.memo is None:
+            return self.classify(text, amount)(date, settlement_date, amount, text, currency)
+
+        key = (normalize_description(text), amount > 0)
+        cached = self.memo.get(key)
+        if cached is not None:
+            cls, info = cached
+            return cls(date, settlement_date, amount, text, currency, info=info)
+
+        transaction = self.classify(text, amount)(date, settlement_date, amount, text, currency)
+        self.memo.put(key, type(transaction), transaction.extracted_info())
+        return transaction
+
+    def classify(self, text, amount):
+        for key, value in DESCRIPTION_TYPE_MAP.items():
+            if text.startswith(key):
+                return value
+
+        if amount > 0:
+            return CreditTransaction
+        else:
+            return DebitTransaction
+
+    def in_window(self, date: datetime) -> bool:
+        return (self.since is None or date >= self.since) and (self.until is None or date <= self.until)
+
+    def record_balance(self, kind, date, amount, page: Optional[int] = None) -> None:
+        if self.since is not None or self.until is not None:
+            # The balances of the statement do not apply to a part of it
+            return
+        if kind == SALDO_INIZIALE:
+            self.balance_tracker.opening(amount, date, self.cur_record, page)
+        else:
+            self.balance_tracker.closing(amount, date, self.cur_record, page)
+
+    def record_transaction(self, transaction, page: Optional[int] = None) -> StatementLine:
+        transaction.id = self.id_generator.generate(transaction)
+        stmt_line = transaction.to_statement_line()
+        if self.rules is not None:
+            self.rules.apply(transaction, stmt_line)
+        # Before the line is counted anywhere, in case it is quarantined
+        stmt_line.assert_valid()
+        self.balance_tracker.add(transaction.amount, self.cur_record, page)
+        for sink in self.sinks:
+            sink.add_line(self.statement, transaction, stmt_line)
+        return stmt_line
+
+    def parse(self) -> Statement:
+        self.balance_tracker = BalanceTracker(self.statement, self.balance_check)
+        self.id_generator = TransactionIdGenerator()
+        statement = super().parse()
+        if self.errors:
+            # The reported balances include the amounts of the quarantined rows
+            self.balance_tracker.drop_balances("%d rows were quarantined" % sum(self.errors.values()))
+        self.balance_tracker.finish()
+        for sink in self.sinks:
+            if hasattr(sink, "end_statement"):
+                sink.end_statement(statement)
+        if self.errors:
+            log.warning("%s: %d rows quarantined (%s)" % (
+                self.source(), sum(self.errors.values()),
+                ", ".join("%s: %d" % item for item in sorted(self.errors.items()))))
+            if self.quarantine is not None:
+                self.quarantine.flush()
+        return statement
+
+    def source(self) -> Optional[str]:
+        """Name of the statement file being parsed"""
+        if getattr(self, "filename", None):
+            return self.filename
+        return getattr(getattr(self, "fin", None), "name", None)
+
+    def raw_values(self, line) -> Dict[str, Any]:
+        if isinstance(line, RowError):
+            line = line.raw
+        if isinstance(line, dict):
+            return {name: value for name, value in line.items() if name != "page"}
+        names = {index: name for name, index in self.columns.items()}
+        return {names.get(index, str(index)): value for index, value in enumerate(line)}
+
+    def quarantine_row(self, line, error: Exception) -> None:
+        """Set aside a row that could not be parsed, in lenient mode"""
+        self.errors[type(error).__name__] += 1
+        page = line.get("page") if isinstance(line, dict) else None
+        self.balance_tracker.skip(self.cur_record, page)
+        if self.quarantine is not None:
+            self.quarantine.add(self.source(), page, self.cur_record, error, self.raw_values(line))
+        else:
+            log.warning("%s: line %d%s skipped: %s" % (
+                self.source(), self.cur_record, " on page %d" % page if page else "",
+                error.message if isinstance(error, ParseError) else error))
@@ -1,31 +1,51 @@
 from ast import Dict
-from typing import Optional, Any, List
+from typing import Optional, Any, Iterable, Iterator, List, Tuple
 from decimal import Decimal, InvalidOperation
-import pandas
+import io
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime
 import tabula
 import PyPDF2
 
 from ofxstatement.parser import StatementParser
 from ofxstatement.statement import StatementLine, Currency, Statement
-from ofxstatement.plugins.bancopostaTransaction import DebitTransaction, CreditTransaction, ATMTransaction, AddebitoDirettoTransaction, AddebitoPreautorizzatoTransaction, BolloTransaction, BonificoTransaction, CommissioneTransaction, PagamentoPostamatTransaction, PostagiroTransaction
-
-DESCRIPTION_TYPE_MAP = {
-    "BONIFICO": BonificoTransaction,
-    "VOSTRA DISPOS. DI BONIFICO": BonificoTransaction,
-    "POSTAGIRO": PostagiroTransaction,
-    "IMPOSTA DI BOLLO": BolloTransaction,
-    "COMMISSIONE": CommissioneTransaction,
-    "PAGAMENTO POSTAMAT": PagamentoPostamatTransaction,
-    "VERSAMENTO": ATMTransaction,
-    "PRELIEVO": ATMTransaction,
-    "ADDEBITO DIRETTO": AddebitoDirettoTransaction,
-    "ADDEBITO PREAUTORIZZATO": AddebitoPreautorizzatoTransaction
-}
-
-class BancoPostaPdfStatementParser(StatementParser):
-    def __init__(self, filename):
+from ofxstatement.plugins.bancopostabalance import balance_row_kind
+from ofxstatement.plugins.bancopostalayout import LayoutDetector
+from ofxstatement.plugins.bancopostaocr import page_has_text
+from ofxstatement.plugins.bancopostaparser import BancoPostaStatementParserMixin
+from ofxstatement.plugins.bancopostaquarantine import quarantined
+
+log = logging.getLogger(__name__)
+
+DATE_PATTERN = re.compile(r"\b\d{2}/\d{2}/\d{2,4}\b")
+
+
+def page_dates(page, date_format: str) -> List[datetime]:
+    """Dates found in the text layer of a page, read without tabula"""
+    dates = []
+    for match in DATE_PATTERN.findall(page.extract_text() or ""):
+        try:
+            dates.append(datetime.strptime(match, date_format))
+        except ValueError:
+            pass
+    return dates
+
+class BancoPostaPdfStatementParser(BancoPostaStatementParserMixin, StatementParser):
+    def __init__(self, filename, data: Optional[bytes] = None):
         super().__init__()
         self.filename = filename
+        # Content of a PDF read from an archive, parsed from memory
+        self.data = data
+        self.spilled = None
+        self.reader = None
+        self.layout_detector = None
+        self.ocr = None
+        # Pages skipped before since, and the dates found on them
+        self.first_page = 1
+        self.skipped_dates = set()
     
     date_format = "%d/%m/%y"
 
@@ -34,7 +54,7 @@ class BancoPostaPdfStatementParser(StatementParser):
     
     def parse_amount(self, value: str) -> Decimal:
         try:
-            result = Decimal(value.replace(" ", "").replace(".", "").replace(",", "."))
+            result = Decimal(value.replace(" ", "").replace("|", "").replace(".", "").replace(",", "."))
             if result.is_nan():
                 return Decimal(0)
             else:
@@ -60,95 +80,144 @@ class BancoPostaPdfStatementParser(StatementParser):
 
         return super().parse_value(value, field)
     
-    def split_records(self) -> List[Dict]:
+    def read_page(self, page: int) -> Iterator[List[str]]:
+        """Extract the table rows of a single page"""
+        area = self.layout_detector.area(self.reader, page)
+        frames = tabula.read_pdf(self.tabula_path(), multiple_tables=False, pages=str(page), stream=True, area=area, pandas_options={'header': None, 'names': self.columns})
+        for frame in frames:
+            # Plain arrays avoid the per-column Series (and their reference
+            # cycles) that itertuples would leave behind on every page
+            for row in frame.to_numpy(dtype=object).tolist():
+                yield ["nan" if value is None else str(value) for value in row]
+
+    def tabula_path(self) -> str:
+        """tabula and the OCR workers run on a file: PDFs in memory are
+        written to a temporary file once, removed when the parsing ends"""
+        if self.data is None:
+            return self.filename
+        if self.spilled is None:
+            fd, self.spilled = tempfile.mkstemp(suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.data)
+        return self.spilled
+
+    def scanned_pages(self, num_pages: int) -> Dict:
+        """Return the table area of the pages without a text layer, to be OCRed"""
+        if self.ocr is None:
+            return {}
+        scanned = {page: self.layout_detector.area(self.reader, page) for page in range(1, num_pages + 1) if not page_has_text(self.reader.pages[page - 1])}
+        if scanned and not self.ocr.available():
+            log.warning(f"{len(scanned)} pages have no text layer, but OCR needs pdftoppm and tesseract installed")
+            return {}
+        return scanned
+
+    def split_records(self) -> Iterator[Dict]:
+        """Stream the records page by page.
+
+        Only the current page and the record still open at the page boundary
+        are kept in memory, whatever the number of pages.
+        """
         num_pages = self.count_pages()
-        
-        dataFrame = tabula.read_pdf(self.filename, multiple_tables=False, pages="1", stream=True, area=(284.637,13.462,731.112,586.438), pandas_options={'header': None, 'names': self.columns})
+        if self.layout_detector is None:
+            self.layout_detector = LayoutDetector()
 
-        if(num_pages > 1):
-            i = 2
-            while i <= num_pages:
-                dataFrame = dataFrame + tabula.read_pdf(self.filename, multiple_tables=False, pages=str(i), stream=True, area=(106.797,11.974,772.045,586.438), pandas_options={'header': None, 'names': self.columns})
-                i += 1
+        self.first_page = self.first_page_since(num_pages)
+        scanned = {page: area for page, area in self.scanned_pages(num_pages).items() if page >= self.first_page}
+        found = False
+        ocr_pages = None
+        try:
+            if scanned:
+                # Workers get the path rather than a copy of the PDF for every page
+                ocr_pages = self.ocr.extract(self.tabula_path(), self.reader, scanned)
+            pages = ((page, next(ocr_pages)[1] if page in scanned else self.read_page(page))
+                     for page in range(self.first_page, num_pages + 1))
+            for record in self.merge_rows(pages):
+                found = True
+                yield record
+        finally:
+            if ocr_pages is not None:
+                # Stop the OCR workers before their input file is removed
+                ocr_pages.close()
+            if self.spilled is not None:
+                os.remove(self.spilled)
+                self.spilled = None
 
-        if(len(dataFrame) == 0):
+        if not found:
             print("Error: no data found in pdf file")
-            return []
-        
-        df = pandas.concat(dataFrame)
-        df = df.astype(str)
-              
-        # Create a new DataFrame to store the result
-        dfresult = pandas.DataFrame(columns=self.columns)
-
-        # Iterate over the rows of the DataFrame
-        i = 0
-        while i < len(df):
-            row = df.iloc[i]
-            data = row["Data"]
-            valuta = row["Valuta"]
-            addebiti = row["Addebiti"]
-            accrediti = row["Accrediti"]
-            description = row["Descrizione operazioni"]
-
-            # Check if the next row is a continuation of the current row
-            while i + 1 < len(df) and df.iloc[i + 1]["Data"] == "nan":
-                description += " " + df.iloc[i + 1]["Descrizione operazioni"]
-                i += 1
-            
-            # Add the row to the result DataFrame
-            dfresult = pandas.concat(
-                [
-                    dfresult,
-                    pandas.DataFrame(
-                        {
-                            "Data": [data],
-                            "Valuta": [valuta],
-                            "Addebiti": [addebiti],
-                            "Accrediti": [accrediti],
-                            "Descrizione operazioni": [description],
-                        }
-                    ),
-                ],
-                ignore_index=True,
-            )
-
-            i += 1
-    
-        result = dfresult.to_dict(orient='records')
-        return result
+
+    def merge_rows(self, pages: Iterator[Tuple[int, Iterable[List[str]]]]) -> Iterator[Dict]:
+        """Turn the rows of the pages into records, stopping after the first
+        page past until"""
+        columns = list(self.columns)
+        data_index = columns.index("Data")
+        description_index = columns.index("Descrizione operazioni")
+
+        record = None
+        for page, rows in pages:
+            past_until = False
+            for row in rows:
+                if self.until is not None and not past_until:
+                    date = self.parse_value(row[data_index], "date")
+                    past_until = date is not None and date > self.until
+                # Rows without a date continue the description of the previous
+                # one, possibly started on the previous page
+                if record is not None and row[data_index] == "nan":
+                    record["Descrizione operazioni"] += " " + row[description_index]
+                    continue
+
+                if record is not None:
+                    yield record
+                record = dict(zip(columns, row))
+                record["page"] = page
+            if past_until:
+                # Statements are in chronological order: the next pages are all later
+                break
+
+        if record is not None:
+            yield record
+
+    def first_page_since(self, num_pages: int) -> int:
+        """Return the first page that may have transactions made on or
+        after since, skipping the pages whose text only has earlier dates"""
+        self.skipped_dates = set()
+        if self.since is None:
+            return 1
+        for page in range(1, num_pages + 1):
+            dates = page_dates(self.reader.pages[page - 1], self.date_format)
+            # Pages without a text layer have an unknown date range
+            if not dates or max(dates) >= self.since:
+                return page
+            self.skipped_dates.update(dates)
+        return num_pages + 1
+
+    def count_skipped(self) -> None:
+        """Count for the ids the transactions of the pages skipped before
+        since. Only needed, and done once, when a later transaction has the
+        same settlement date as one of them, and so possibly the same key."""
+        self.skipped_dates = set()
+        for record in self.merge_rows((page, self.read_page(page)) for page in range(1, self.first_page)):
+            try:
+                transaction = self.parse_transaction(record)
+            except Exception:
+                # Not a transaction of the full parse either
+                continue
+            if transaction is not None:
+                self.id_generator.skip(transaction)
 
     def count_pages(self):
-        pdf = open(self.filename, 'rb')
-        pdfReader = PyPDF2.PdfReader(pdf)
-        num_pages = len(pdfReader.pages)
+        if self.reader is None:
+            self.reader = PyPDF2.PdfReader(io.BytesIO(self.data) if self.data is not None else self.filename)
+        num_pages = len(self.reader.pages)
         print(f'The PDF has {num_pages} pages.')
         return num_pages
     
-    def create_transaction(self, text, date, settlement_date, amount, currency):
-        for key, value in DESCRIPTION_TYPE_MAP.items():
-            if text.startswith(key):
-                return value(date, settlement_date, amount, text, currency)
-        
-        if amount > 0:
-            return CreditTransaction(date, settlement_date, amount, text, currency)
-        else:
-            return DebitTransaction(date, settlement_date, amount, text, currency)
-
-        return None     
-
-    def parse_record(self, line: Dict) -> Optional[StatementLine]:
-        # Ignore the header
-        # if self.cur_record <= 1:
-        #     return None
-
-        # Ignore Saldo iniziale/finale      
+    def parse_transaction(self, line: Dict):
+        """Return the transaction of a record, None for the other rows"""
         settlementDate = self.parse_value(line["Valuta"], "date")
-        if(settlementDate is None):
+        if settlementDate is None:
             return None
-        
         date = self.parse_value(line["Data"], "date")
-        
+
         income = self.parse_value(line["Accrediti"], "amount")
         outcome = self.parse_value(line["Addebiti"], "amount")
 
@@ -156,9 +225,34 @@ class BancoPostaPdfStatementParser(StatementParser):
         currency = self.parse_value("EUR", "currency")
 
         description = line["Descrizione operazioni"]
-        
-        transaction = self.create_transaction(description, date, settlementDate, amount, currency)
-        stmt_line = transaction.to_statement_line()
+
+        return self.create_transaction(description, date, settlementDate, amount, currency)
+
+    @quarantined
+    def parse_record(self, line: Dict) -> Optional[StatementLine]:
+        # Ignore the header
+        # if self.cur_record <= 1:
+        #     return None
+
+        page = line["page"]
+
+        transaction = self.parse_transaction(line)
+        # Saldo iniziale/finale only update the balances
+        if transaction is None:
+            kind = balance_row_kind(line["Descrizione operazioni"])
+            if kind:
+                balance = self.parse_value(line["Accrediti"], "amount") - self.parse_value(line["Addebiti"], "amount")
+                self.record_balance(kind, self.parse_value(line["Data"], "date"), balance, page)
+            return None
+
+        if transaction.settlement_date in self.skipped_dates:
+            self.count_skipped()
+        # Same date as the page pruning in split_records: statements are sorted by it
+        if transaction.date is not None and not self.in_window(transaction.date):
+            self.id_generator.skip(transaction)
+            return None
+
+        stmt_line = self.record_transaction(transaction, page)
 
         return stmt_line
 
@@ -0,0 +1,94 @@
+import functools
+import json
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from ofxstatement.exceptions import ParseError
+from ofxstatement.plugins.bancopostabalance import BalanceMismatch
+
+# Possible values for the on_error setting:
+# - strict: abort the conversion on the first row that cannot be parsed.
+# - lenient: quarantine the row, keep parsing and report the errors at the end.
+ON_ERROR_STRICT = "strict"
+ON_ERROR_LENIENT = "lenient"
+ON_ERROR_MODES = (ON_ERROR_STRICT, ON_ERROR_LENIENT)
+
+
+class RowError:
+    """A row that a chunk worker could not parse, with its raw values"""
+
+    __slots__ = ("error", "raw")
+
+    def __init__(self, error: Exception, raw):
+        self.error = error
+        self.raw = raw
+
+    def exception(self, lineno: int) -> Exception:
+        # The worker only knows the line number within its chunk
+        if isinstance(self.error, ParseError):
+            return ParseError(lineno, self.error.message)
+        return self.error
+
+
+class Quarantine:
+    """JSON lines file collecting the rows that could not be parsed.
+
+    Every row is written with the statement file, page and line it comes
+    from, the error and its raw values, so that it can be fixed and
+    converted on its own without processing the whole batch again.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = None
+        self.errors: Counter = Counter()
+
+    def add(self, source: Optional[str], page: Optional[int], line: int, error: Exception, raw: Dict[str, Any]) -> None:
+        if self.file is None:
+            self.file = open(self.filename, "a", encoding="utf-8")
+        record = {
+            "file": source,
+            "page": page,
+            "line": line,
+            "error": type(error).__name__,
+            "message": error.message if isinstance(error, ParseError) else str(error),
+            "raw": raw,
+        }
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self.errors[type(error).__name__] += 1
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def quarantined(parse_record):
+    """Decorate parse_record so that, in lenient mode, a row that fails is
+    quarantined instead of aborting the conversion. Balance mismatches of
+    the strict balance_check still abort it."""
+
+    @functools.wraps(parse_record)
+    def wrapper(self, line):
+        if self.on_error != ON_ERROR_LENIENT:
+            return parse_record(self, line)
+        try:
+            return parse_record(self, line)
+        except BalanceMismatch:
+            # Reconciliation is about the statement, not about this row
+            raise
+        except Exception as e:
+            self.quarantine_row(line, e)
+            return None
+
+    return wrapper
@@ -0,0 +1,221 @@
+import csv
+import hashlib
+import os
+import re
+from collections import deque
+from typing import Dict, List, Optional, Pattern
+
+from ofxstatement.statement import TRANSACTION_TYPES
+from ofxstatement.plugins.bancopostacache import cache_dir, load_pickle, store_pickle
+
+# Bump when the compiled representation changes, to invalidate old caches
+RULES_CACHE_VERSION = 1
+
+MATCH_SUBSTRING = "substring"
+MATCH_PREFIX = "prefix"
+MATCH_REGEX = "regex"
+MATCH_TYPES = (MATCH_SUBSTRING, MATCH_PREFIX, MATCH_REGEX)
+
+RULES_COLUMNS = ["match", "pattern", "payee", "trntype", "category"]
+
+# (?i), (?s)... at the start of a pattern apply to the whole expression
+GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+class Rule:
+    """A payee normalization rule.
+
+    payee, trntype and category are optional: empty values keep what the
+    transaction classes extracted.
+    """
+
+    __slots__ = ("match", "pattern", "payee", "trntype", "category")
+
+    def __init__(self, match, pattern, payee=None, trntype=None, category=None):
+        self.match = match
+        self.pattern = pattern
+        self.payee = payee or None
+        self.trntype = trntype or None
+        self.category = category or None
+
+    def __getstate__(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return f"Rule({self.match!r}, {self.pattern!r}, {self.payee!r}, {self.trntype!r}, {self.category!r})"
+
+
+def read_rules(filename: str) -> List[Rule]:
+    """Read a rules file.
+
+    The file is a ';' separated CSV with the columns
+    match;pattern;payee;trntype;category, where match is one of
+    substring, prefix or regex. Rules are matched case-insensitively and the
+    first rule of the file that matches a description wins. Regexes cannot
+    use groups or inline global flags, as they are joined into one pattern.
+    """
+    rules = []
+    lines = []
+    with open(filename, "r", encoding="utf-8") as f:
+        reader = csv.DictReader(f, delimiter=";")
+        missing = set(RULES_COLUMNS[:2]) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"{filename}: missing columns {', '.join(sorted(missing))}")
+        for row in reader:
+            values = {col: (row.get(col) or "").strip() for col in RULES_COLUMNS}
+            where = f"{filename}:{reader.line_num}"
+            if values["match"] not in MATCH_TYPES:
+                raise ValueError(f"{where}: invalid match '{values['match']}', expected one of {', '.join(MATCH_TYPES)}")
+            if not values["pattern"]:
+                raise ValueError(f"{where}: empty pattern")
+            if values["trntype"] and values["trntype"] not in TRANSACTION_TYPES:
+                raise ValueError(f"{where}: invalid trntype '{values['trntype']}'")
+            if values["match"] == MATCH_REGEX:
+                check_regex(values["pattern"], where)
+            rules.append(Rule(**values))
+            lines.append(where)
+
+    # The regex rules are joined into one pattern: check that it compiles,
+    # reporting the first rule that breaks it
+    try:
+        combined_regex(rules)
+    except re.error:
+        for count in range(1, len(rules) + 1):
+            try:
+                combined_regex(rules[:count])
+            except re.error as e:
+                raise ValueError(f"{lines[count - 1]}: regex cannot be combined with the previous rules: {e}")
+    return rules
+
+
+def check_regex(pattern: str, where: str) -> None:
+    """Reject the regexes that would not work once joined with the others"""
+    if GLOBAL_FLAGS.match(pattern):
+        raise ValueError(f"{where}: inline global flags are not supported, rules are already case-insensitive")
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"{where}: invalid regex: {e}")
+    # Group names and numbers would clash with those of the other rules
+    if compiled.groups:
+        raise ValueError(f"{where}: regex groups are not supported, use (?:...) instead")
+
+
+def combined_regex(rules: List[Rule]) -> Optional[Pattern]:
+    """Join the regex rules into one pattern matching the first rule in file order"""
+    alternatives = []
+    for index, rule in enumerate(rules):
+        if rule.match == MATCH_REGEX:
+            # Each alternative looks ahead over the whole description, so
+            # the alternation picks the first matching rule in file order.
+            alternatives.append(f"(?=.*?(?:{rule.pattern}))(?P<r{index}>)")
+    return re.compile("|".join(alternatives), re.IGNORECASE | re.DOTALL) if alternatives else None
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton finding every keyword of a set in one pass"""
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # (keyword length, value) pairs of the keywords ending in each state
+        self.output: List[List[tuple]] = [[]]
+
+    def add(self, keyword: str, value) -> None:
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append((len(keyword), value))
+
+    def build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def iter(self, text: str):
+        """Yield (start, value) for every keyword occurrence in text"""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                yield end - length + 1, value
+
+
+class CompiledRules:
+    """Rules compiled into one automaton for the substring/prefix rules and
+    one combined regular expression for the regex rules."""
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.automaton = AhoCorasick()
+        for index, rule in enumerate(rules):
+            if rule.match != MATCH_REGEX:
+                self.automaton.add(rule.pattern.upper(), index)
+        self.automaton.build()
+        self.regex = combined_regex(rules)
+
+    def match(self, description: str) -> Optional[Rule]:
+        best = len(self.rules)
+        for start, index in self.automaton.iter(description.upper()):
+            if index < best and (start == 0 or self.rules[index].match == MATCH_SUBSTRING):
+                best = index
+                if best == 0:
+                    break
+
+        if self.regex is not None:
+            match = self.regex.match(description)
+            if match:
+                index = int(match.lastgroup[1:])
+                best = min(best, index)
+
+        return self.rules[best] if best < len(self.rules) else None
+
+    def apply(self, transaction, stmt_line) -> Optional[Rule]:
+        rule = self.match(transaction.description)
+        if rule is None:
+            return None
+        if rule.payee:
+            transaction.payee = rule.payee
+            stmt_line.payee = rule.payee
+        if rule.trntype:
+            stmt_line.trntype = rule.trntype
+        if rule.category:
+            transaction.category = rule.category
+        return rule
+
+
+def load_rules(filename: str, cache_path: Optional[str] = None) -> CompiledRules:
+    """Load the compiled rules of filename, compiling them only when the
+    content of the file is not in the cache yet."""
+    with open(filename, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    cached = os.path.join(cache_dir(cache_path), f"rules-{RULES_CACHE_VERSION}-{digest}.pickle")
+    compiled = load_pickle(cached)
+    if isinstance(compiled, CompiledRules):
+        return compiled
+
+    compiled = CompiledRules(read_rules(filename))
+    store_pickle(cached, compiled)
+    return compiled
@@ -0,0 +1,159 @@
+import sqlite3
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional
+
+DEFAULT_BATCH_SIZE = 10000
+
+COLUMNS = [
+    "account_id", "id", "date", "settlement_date", "amount_cents", "currency", "trntype",
+    "payee", "reason", "memo", "reference", "operation", "card", "category",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    account_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    date TEXT,
+    settlement_date TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    currency TEXT,
+    trntype TEXT,
+    payee TEXT,
+    reason TEXT,
+    memo TEXT,
+    reference TEXT,
+    operation TEXT,
+    card TEXT,
+    category TEXT,
+    PRIMARY KEY (account_id, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_account_date ON transactions (account_id, settlement_date);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (settlement_date);
+CREATE INDEX IF NOT EXISTS transactions_amount ON transactions (amount_cents);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+    payee, reason, memo,
+    content='transactions', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS transactions_ai AFTER INSERT ON transactions BEGIN
+    INSERT INTO transactions_fts (rowid, payee, reason, memo) VALUES (new.rowid, new.payee, new.reason, new.memo);
+END;
+CREATE TRIGGER IF NOT EXISTS transactions_ad AFTER DELETE ON transactions BEGIN
+    INSERT INTO transactions_fts (transactions_fts, rowid, payee, reason, memo) VALUES ('delete', old.rowid, old.payee, old.reason, old.memo);
+END;
+CREATE TRIGGER IF NOT EXISTS transactions_au AFTER UPDATE ON transactions BEGIN
+    INSERT INTO transactions_fts (transactions_fts, rowid, payee, reason, memo) VALUES ('delete', old.rowid, old.payee, old.reason, old.memo);
+    INSERT INTO transactions_fts (rowid, payee, reason, memo) VALUES (new.rowid, new.payee, new.reason, new.memo);
+END;
+"""
+
+UPSERT = "INSERT INTO transactions ({0}) VALUES ({1}) ON CONFLICT (account_id, id) DO UPDATE SET {2}".format(
+    ", ".join(COLUMNS),
+    ", ".join("?" for _ in COLUMNS),
+    ", ".join(f"{col} = excluded.{col}" for col in COLUMNS[2:]),
+)
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS query matching all the words, as prefixes"""
+    terms = ['"%s"*' % term.replace('"', '""') for term in text.split()]
+    return " ".join(terms)
+
+
+def to_iso(value) -> Optional[str]:
+    return value.strftime("%Y-%m-%d") if value is not None else None
+
+
+class TransactionStore:
+    """Local SQLite store of the parsed transactions with full-text search
+    on payee, reason and description.
+
+    It is a parser sink: transactions are buffered and inserted in large
+    batches, each in a single transaction. Converting the same statement
+    again updates its transactions instead of duplicating them.
+    """
+
+    def __init__(self, filename: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.pending: List[tuple] = []
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def add_line(self, statement, transaction, stmt_line) -> None:
+        record = transaction.to_record(stmt_line)
+        self.pending.append((
+            statement.account_id,
+            record["id"],
+            to_iso(record["date"]),
+            to_iso(record["settlement_date"]),
+            int(record["amount"] * 100),
+            record["currency"],
+            record["trntype"],
+            record["payee"],
+            record["reason"],
+            record["memo"],
+            record["reference"],
+            record["operation"],
+            record["card"],
+            record["category"],
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def end_statement(self, statement) -> None:
+        self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(UPSERT, self.pending)
+        self.pending = []
+
+    def search(self, text: Optional[str] = None, account_id: Optional[str] = None,
+               since: Optional[str] = None, until: Optional[str] = None,
+               limit: Optional[int] = 100) -> Iterator[Dict]:
+        """Return the transactions matching all the words of text in payee,
+        reason or description, most recent first"""
+        self.flush()
+        query = "SELECT {0} FROM transactions t".format(", ".join(f"t.{col}" for col in COLUMNS))
+        where = []
+        params: List = []
+        if text:
+            query += " JOIN transactions_fts f ON f.rowid = t.rowid"
+            where.append("transactions_fts MATCH ?")
+            params.append(fts_query(text))
+        if account_id:
+            where.append("t.account_id = ?")
+            params.append(account_id)
+        if since:
+            where.append("t.settlement_date >= ?")
+            params.append(since)
+        if until:
+            where.append("t.settlement_date <= ?")
+            params.append(until)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY t.settlement_date DESC, t.id"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        for row in self.connection.execute(query, params):
+            record = dict(zip(COLUMNS, row))
+            record["amount"] = Decimal(record.pop("amount_cents")).scaleb(-2)
+            yield record
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,230 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import shutil
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, MutableMapping, Optional, Set, Tuple
+
+from ofxstatement import ofx, ui
+from ofxstatement.plugins.bancoposta import BancoPostaPlugin
+from ofxstatement.plugins.bancopostaarchive import is_archive, split_compression
+from ofxstatement.plugins.bancopostacache import atomic_write
+
+log = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Files still being downloaded or written by common tools
+PARTIAL_SUFFIXES = (".part", ".partial", ".tmp", ".crdownload", ".download")
+STATEMENT_SUFFIXES = (".csv", ".pdf")
+
+DEFAULT_SETTLE_TIME = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+def is_statement(name: str) -> bool:
+    if name.startswith(".") or name.lower().endswith(PARTIAL_SUFFIXES):
+        return False
+    return is_archive(name) or split_compression(name)[0] in STATEMENT_SUFFIXES
+
+
+def output_name(name: str) -> str:
+    """Name of the OFX file of a statement: EC_2023.csv.gz gives
+    EC_2023.csv.gz.ofx. The whole name is kept, so that EC_2023.csv and
+    EC_2023.pdf dropped in the same directory do not overwrite each other."""
+    return name + ".ofx"
+
+
+class PollingWatcher:
+    """Report the new files of a directory by listing it periodically"""
+
+    def __init__(self, directory: str, interval: float = DEFAULT_POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.known: Set[str] = set()
+
+    def wait(self, timeout: float) -> List[str]:
+        time.sleep(min(timeout, self.interval))
+        names = {entry.name for entry in os.scandir(self.directory) if entry.is_file()}
+        new = names - self.known
+        self.known = names
+        return sorted(new)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """Report the files written or moved into a directory, through inotify"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    @staticmethod
+    def supported() -> bool:
+        return sys.platform.startswith("linux") and hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+
+    def wait(self, timeout: float) -> List[str]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: fall back to a listing of the directory
+                names.extend(entry.name for entry in os.scandir(self.directory) if entry.is_file())
+            elif name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+worker_plugin: Optional[BancoPostaPlugin] = None
+
+
+def init_worker(settings: MutableMapping) -> None:
+    global worker_plugin
+    worker_plugin = BancoPostaPlugin(ui.UI(), settings)
+
+
+def convert_file(filename: str, output: str, encoding: str = "utf-8") -> str:
+    """Convert a statement to OFX, in a worker process"""
+    parser = worker_plugin.get_parser(filename)
+    try:
+        statement = parser.parse()
+    finally:
+        # The CSV parser reads from a file opened by get_parser
+        if getattr(parser, "fin", None) is not None:
+            parser.fin.close()
+    statement.assert_valid()
+    writer = ofx.OfxWriter(statement)
+    atomic_write(output, writer.toxml(pretty=True, encoding=encoding).encode(encoding))
+    return output
+
+
+class DirectoryWatcher:
+    """Convert the statements dropped in a directory as soon as they land.
+
+    New files are reported by inotify (or by polling where inotify is not
+    available) and are converted once their size and modification time have
+    been stable for settle_time seconds. Conversions run in a bounded pool of
+    worker processes; each input is then moved to the done or failed
+    directory, so it is never looked at again.
+    """
+
+    def __init__(self, directory: str, settings: MutableMapping, output_dir: Optional[str] = None,
+                 done_dir: Optional[str] = None, failed_dir: Optional[str] = None,
+                 workers: int = 2, settle_time: float = DEFAULT_SETTLE_TIME, polling: bool = False):
+        self.directory = directory
+        self.settings = settings
+        self.output_dir = output_dir or directory
+        self.done_dir = done_dir or os.path.join(directory, "done")
+        self.failed_dir = failed_dir or os.path.join(directory, "failed")
+        self.workers = workers
+        self.settle_time = settle_time
+        self.polling = polling or not InotifyWatcher.supported()
+        # name -> (size, mtime, time of the last change)
+        self.pending: Dict[str, Tuple[int, float, float]] = {}
+        self.running: Dict[str, Future] = {}
+        self.converted = 0
+        self.failed = 0
+
+    def notice(self, name: str) -> None:
+        if name in self.running or not is_statement(name):
+            return
+        self.pending.setdefault(name, (-1, -1.0, time.monotonic()))
+
+    def check_pending(self, executor) -> None:
+        """Submit the pending files that have stopped changing"""
+        now = time.monotonic()
+        for name, (size, mtime, changed) in list(self.pending.items()):
+            if len(self.running) >= self.workers:
+                # Keep the queue bounded: the rest waits for a free worker
+                return
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.pending[name] = (stat.st_size, stat.st_mtime, now)
+            elif now - changed >= self.settle_time:
+                del self.pending[name]
+                output = os.path.join(self.output_dir, output_name(name))
+                encoding = self.settings.get("encoding", "utf-8")
+                self.running[name] = executor.submit(convert_file, os.path.join(self.directory, name), output, encoding)
+
+    def collect(self) -> None:
+        """Move the inputs of the finished conversions to done or failed"""
+        for name, future in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[name]
+            error = future.exception()
+            if error is None:
+                self.converted += 1
+                log.info(f"{name}: converted to {future.result()}")
+                target = self.done_dir
+            else:
+                self.failed += 1
+                log.error(f"{name}: conversion failed: {error}")
+                target = self.failed_dir
+            try:
+                shutil.move(os.path.join(self.directory, name), os.path.join(target, name))
+            except OSError as e:
+                # Removed or renamed while it was being converted
+                log.error(f"{name}: cannot move to {target}: {e}")
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        for path in (self.output_dir, self.done_dir, self.failed_dir):
+            os.makedirs(path, exist_ok=True)
+
+        watcher = PollingWatcher(self.directory) if self.polling else InotifyWatcher(self.directory)
+        log.info(f"Watching {self.directory} ({'polling' if self.polling else 'inotify'})")
+        # Files dropped while nobody was watching
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                self.notice(entry.name)
+
+        stop = stop or threading.Event()
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(dict(self.settings),))
+        try:
+            while not stop.is_set():
+                busy = self.pending or self.running
+                for name in watcher.wait(0.1 if busy else 1.0):
+                    self.notice(name)
+                self.check_pending(executor)
+                self.collect()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.collect()
+            watcher.close()
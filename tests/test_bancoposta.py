@@ -1,8 +1,35 @@
-import os
+import bz2
+import csv
 import datetime
+import gc
+import gzip
+import io
+import json
+import lzma
+import os
+import shutil
+import tarfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from concurrent.futures import Future
 from decimal import Decimal
 
+import pandas
+import PyPDF2
+import pytest
+
+from ofxstatement.exceptions import ParseError
+from ofxstatement.plugins.bancopostabalance import BalanceMismatch
+from ofxstatement.plugins import bancopostacli, bancopostalayout, bancopostaocr, bancopostapdfparser
 from ofxstatement.plugins.bancoposta import BancoPostaPlugin
+from ofxstatement.plugins.bancopostapdfparser import BancoPostaPdfStatementParser
+from ofxstatement.plugins.bancopostalayout import LayoutDetector
+from ofxstatement.plugins.bancopostachunks import split_ranges
+from ofxstatement.plugins.bancopostarules import read_rules
+from ofxstatement.plugins.bancopostaTransaction import ATMTransaction
+from ofxstatement.plugins.bancopostawatch import DirectoryWatcher, InotifyWatcher, output_name
 from ofxstatement.ui import UI
 
 HERE = os.path.dirname(__file__)
@@ -287,4 +314,870 @@ def test_bancoposta_commissione() -> None:
     assert line2.date == datetime.datetime(2018, 8, 3, 0, 0, 0)
     assert line2.payee == "COMMISSIONE RICARICA PREPAGATA"
     assert line2.memo == "COMMISSIONE RICARICA PREPAGATA ADDEBITO IN CONTO DA APP/WEB Ricarica Postepay da APP addebito su conto"
-    assert line2.trntype == "SRVCHG"
\ No newline at end of file
+    assert line2.trntype == "SRVCHG"
+
+def test_bancoposta_balance() -> None:
+    plugin = BancoPostaPlugin(UI(), {"balance_check": "strict"})
+    filename = os.path.join(HERE, "samples", "transactions", "commissione.csv")
+
+    parser = plugin.get_parser(filename)
+    statement = parser.parse()
+
+    assert statement.start_balance == Decimal("100.95")
+    assert statement.start_date == datetime.datetime(2017, 12, 31, 0, 0, 0)
+    assert statement.end_balance == Decimal("96.95")
+    assert statement.end_date == datetime.datetime(2018, 8, 31, 0, 0, 0)
+    assert parser.balance_tracker.mismatches == 0
+
+def test_bancoposta_balance_mismatch() -> None:
+    plugin = BancoPostaPlugin(UI(), {"balance_check": "strict"})
+    filename = os.path.join(HERE, "samples", "bancoposta.csv")
+
+    parser = plugin.get_parser(filename)
+    with pytest.raises(ParseError) as excinfo:
+        parser.parse()
+
+    assert excinfo.value.lineno == 7
+    assert "lines 2-7" in excinfo.value.message
+
+def test_bancoposta_balance_mismatch_warn(caplog) -> None:
+    plugin = BancoPostaPlugin(UI(), {})
+    filename = os.path.join(HERE, "samples", "bancoposta.csv")
+
+    parser = plugin.get_parser(filename)
+    statement = parser.parse()
+
+    assert len(statement.lines) == 4
+    assert parser.balance_tracker.mismatches == 1
+    assert "does not match SALDO FINALE" in caplog.text
+    # the balances that do not reconcile are left out, so that the OFX can be written
+    assert statement.start_balance is None and statement.end_balance is None
+    assert statement.start_date == datetime.datetime(2017, 12, 31)
+    statement.assert_valid()
+
+    # the bundled samples that do not reconcile still convert without balance checks
+    for sample in ["addebito_diretto.csv", "bonifico.csv", "postagiro.csv"]:
+        for mode in ["warn", "off"]:
+            filename = os.path.join(HERE, "samples", "transactions", sample)
+            BancoPostaPlugin(UI(), {"balance_check": mode}).get_parser(filename).parse().assert_valid()
+
+def test_bancoposta_transaction_id() -> None:
+    plugin = BancoPostaPlugin(UI(), {})
+    filename = os.path.join(HERE, "samples", "transactions", "commissione_duplicata.csv")
+
+    statement = plugin.get_parser(filename).parse()
+
+    assert len(statement.lines) == 3
+    ids = [line.id for line in statement.lines]
+    assert len(set(ids)) == 3
+    assert ids[2] == ids[1] + "-1"
+
+    # ids are stable across runs
+    assert ids == [line.id for line in plugin.get_parser(filename).parse().lines]
+
+def test_bancoposta_rules(tmp_path, monkeypatch) -> None:
+    settings = {
+        "rules": os.path.join(HERE, "samples", "rules.csv"),
+        "cache_dir": str(tmp_path),
+    }
+    plugin = BancoPostaPlugin(UI(), settings)
+    filename = os.path.join(HERE, "samples", "bancoposta.csv")
+
+    statement = plugin.get_parser(filename).parse()
+
+    line0 = statement.lines[0]
+    assert line0.payee == "IMPOSTA DI BOLLO"
+    assert line0.trntype == "FEE"
+
+    line1 = statement.lines[1]
+    assert line1.payee == "Postepay"
+    assert line1.trntype == "XFER"
+
+    line2 = statement.lines[2]
+    assert line2.payee == "Ricarica Postepay"
+    assert line2.trntype == "SRVCHG"
+
+    line3 = statement.lines[3]
+    assert line3.payee == "Datore di lavoro"
+    assert line3.trntype == "DIRECTDEP"
+
+    # the compiled rules are cached by content hash and reused
+    assert len(os.listdir(tmp_path)) == 1
+    cached = BancoPostaPlugin(UI(), settings).get_rules()
+    assert [rule.category for rule in cached.rules] == ["Trasferimenti", "Stipendio", "Commissioni", "Tasse"]
+
+    # regexes that would break the combined pattern are reported with their line
+    for pattern, error in [("(?i)esselunga", "inline global flags"), ("(?P<shop>coop)", "groups are not supported"),
+                           ("(conad)\\s+\\1", "groups are not supported"), ("esse[lunga", "invalid regex")]:
+        bad_rules = tmp_path / "bad_rules.csv"
+        bad_rules.write_text(f"match;pattern;payee\nregex;supermercato;Spesa\nregex;{pattern};Spesa\n")
+        with pytest.raises(ValueError, match=f"bad_rules.csv:3: .*{error}"):
+            read_rules(str(bad_rules))
+    bad_rules.write_text("match;pattern;payee\nregex;(?i:esselunga)|(?:coop|conad);Spesa\n")
+    assert [rule.pattern for rule in read_rules(str(bad_rules))] == ["(?i:esselunga)|(?:coop|conad)"]
+
+    # paths in the configuration may start with ~
+    home = tmp_path / "home"
+    (home / "bancoposta").mkdir(parents=True)
+    shutil.copy(settings["rules"], home / "bancoposta" / "rules.csv")
+    monkeypatch.setenv("HOME", str(home))
+    rules = BancoPostaPlugin(UI(), {"rules": "~/bancoposta/rules.csv", "cache_dir": "~/cache"}).get_rules()
+    assert [rule.category for rule in rules.rules] == ["Trasferimenti", "Stipendio", "Commissioni", "Tasse"]
+    assert len(os.listdir(home / "cache")) == 1
+
+def test_bancoposta_layout_detection(tmp_path, monkeypatch) -> None:
+    reader = PyPDF2.PdfReader(os.path.join(HERE, "samples", "layout.pdf"))
+
+    detector = LayoutDetector(str(tmp_path))
+    assert detector.area(reader, 1) == (269.89, 13.5, 731.112, 586.78)
+    assert detector.area(reader, 2) == (89.89, 13.5, 772.045, 586.78)
+    assert len(os.listdir(tmp_path)) == 2
+
+    # the next statement with the same layout reuses the cached areas
+    def detect_area(page, page_number, header=None):
+        raise AssertionError("layout detected twice")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(bancopostalayout, "detect_area", detect_area)
+        detector = LayoutDetector(str(tmp_path))
+        assert detector.area(reader, 1) == (269.89, 13.5, 731.112, 586.78)
+        assert detector.area(reader, 2) == (89.89, 13.5, 772.045, 586.78)
+
+    # same producer and page size, but the table moved: the cached area no
+    # longer holds the header and the layout is detected again
+    detector = LayoutDetector(str(tmp_path))
+    cache_file = detector.cache_file(bancopostalayout.layout_fingerprint(reader, 1))
+    bancopostalayout.store_pickle(cache_file, (400.0, 13.5, 731.112, 586.78))
+    assert detector.area(reader, 1) == (269.89, 13.5, 731.112, 586.78)
+    assert bancopostalayout.load_pickle(cache_file) == (269.89, 13.5, 731.112, 586.78)
+
+    # a detector shared by the files of a run checks every new statement once per layout
+    calls = []
+    find_header = bancopostalayout.find_header
+    monkeypatch.setattr(bancopostalayout, "find_header", lambda page: calls.append(page) or find_header(page))
+    detector = LayoutDetector(str(tmp_path))
+    for statement in range(2):
+        reader = PyPDF2.PdfReader(os.path.join(HERE, "samples", "layout.pdf"))
+        for page in [1, 2, 2]:
+            assert detector.area(reader, page) == ((269.89, 13.5, 731.112, 586.78) if page == 1 else (89.89, 13.5, 772.045, 586.78))
+    assert len(calls) == 4
+
+
+def test_bancoposta_layout_header() -> None:
+    class Box:
+        width = 595.28
+        height = 841.89
+
+    class Page:
+        mediabox = Box()
+
+        def extract_text(self, visitor_text):
+            # a "Data ..." line above the table comes before the header
+            for text, x, y in [("Data di emissione 31/01/18", 80, 700), ("Estratto conto", 22, 690),
+                               ("Data", 22, 572), ("Valuta", 80, 572), ("Addebiti", 150, 572),
+                               ("Accrediti", 220, 572), ("Descrizione operazioni", 290, 572)]:
+                visitor_text(text, [1, 0, 0, 1, 0, 0], [1, 0, 0, 1, x, y], None, 10)
+
+    header = bancopostalayout.find_header(Page())
+    assert header["Data"] == (22, 572)
+    assert bancopostalayout.detect_area(Page(), 1) == (257.89, 13.5, 731.112, 586.78)
+
+    # without Data the columns cannot be told apart
+    class NoData(Page):
+        def extract_text(self, visitor_text):
+            for text, x in [("Valuta", 80), ("Addebiti", 150), ("Accrediti", 220), ("Descrizione operazioni", 290)]:
+                visitor_text(text, [1, 0, 0, 1, 0, 0], [1, 0, 0, 1, x, 572], None, 10)
+
+    assert bancopostalayout.find_header(NoData()) is None
+
+PDF_PAGES = {
+    1: [
+        ["Data", "Valuta", "Addebiti", "Accrediti", "Descrizione operazioni"],
+        ["31/12/17", None, None, "100,95", "SALDO INIZIALE"],
+        ["03/01/18", "03/01/18", "2,90", None, "IMPOSTA DI BOLLO"],
+        ["13/01/18", "13/01/18", None, "1.250,00", "BONIFICO A VOSTRO FAVORE TRN BBBBBBBB"],
+    ],
+    2: [
+        [None, None, None, None, "XXXXXXXXXXXXXXXXXXXXXXXXXXXXIT DA NOME_MITTENTE"],
+        [None, None, None, None, "PER CAUSALE_BONIFICO"],
+        ["31/01/18", "31/01/18", "1,00", None, "COMMISSIONE"],
+        ["31/01/18", None, None, "1.347,05", "SALDO FINALE"],
+    ],
+}
+
+
+def fake_read_pdf(pdf_pages):
+    def read_pdf(filename, pages=None, pandas_options=None, **kwargs):
+        return [pandas.DataFrame(pdf_pages[int(pages)], columns=list(pandas_options["names"]))]
+
+    return read_pdf
+
+
+def test_bancoposta_pdf(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", fake_read_pdf(PDF_PAGES))
+    plugin = BancoPostaPlugin(UI(), {"balance_check": "strict", "cache_dir": str(tmp_path)})
+    filename = os.path.join(HERE, "samples", "layout.pdf")
+
+    statement = plugin.get_parser(filename).parse()
+
+    assert len(statement.lines) == 3
+    assert statement.start_balance == Decimal("100.95")
+    assert statement.end_balance == Decimal("1347.05")
+
+    line1 = statement.lines[1]
+    assert line1.amount == Decimal("1250.00")
+    assert line1.payee == "NOME_MITTENTE - CAUSALE_BONIFICO"
+    assert line1.memo == "BONIFICO A VOSTRO FAVORE TRN BBBBBBBB XXXXXXXXXXXXXXXXXXXXXXXXXXXXIT DA NOME_MITTENTE PER CAUSALE_BONIFICO"
+
+
+def test_bancoposta_pdf_memory(monkeypatch) -> None:
+    rows = [["%02d/01/18" % (i % 28 + 1), "%02d/01/18" % (i % 28 + 1), "1,00", None, "COMMISSIONE " + "X" * 80] for i in range(50)]
+
+    def read_pdf(filename, pages=None, pandas_options=None, **kwargs):
+        # pandas leaves cyclic garbage behind: collect it so that only the
+        # memory actually held by the parser is measured
+        gc.collect()
+        return [pandas.DataFrame(rows, columns=list(pandas_options["names"]))]
+
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", read_pdf)
+
+    class Layout:
+        def area(self, reader, page):
+            return (0, 0, 0, 0)
+
+    def peak_memory(num_pages):
+        parser = BancoPostaPdfStatementParser("statement.pdf")
+        parser.columns = {col: i for i, col in enumerate(["Data", "Valuta", "Addebiti", "Accrediti", "Descrizione operazioni"])}
+        parser.layout_detector = Layout()
+        monkeypatch.setattr(parser, "count_pages", lambda: num_pages)
+
+        tracemalloc.start()
+        records = sum(1 for record in parser.split_records())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert records == num_pages * len(rows)
+        return peak
+
+    # once pandas is warmed up, the peak memory of the extraction does not grow
+    # with the number of pages; parse() still keeps every line in the statement
+    peak_memory(30)
+    gc.freeze()
+    try:
+        assert peak_memory(300) < peak_memory(30) * 1.2
+    finally:
+        gc.unfreeze()
+
+def test_bancoposta_arrow_export(tmp_path) -> None:
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    output = str(tmp_path / "transactions.parquet")
+    inputs = [
+        os.path.join(HERE, "samples", "transactions", "bonifico.csv"),
+        os.path.join(HERE, "samples", "transactions", "pagamento_postamat.csv"),
+    ]
+    assert bancopostacli.run(["export", "--batch-size", "4", "-o", output] + inputs) == 0
+
+    table = pyarrow.parquet.read_table(output)
+    assert table.num_rows == 9
+    assert table.schema.field("amount_cents").type == pyarrow.int64()
+    assert table.schema.field("settlement_date").type == pyarrow.date32()
+    assert pyarrow.types.is_dictionary(table.schema.field("payee").type)
+
+    rows = table.to_pylist()
+    assert rows[1]["amount_cents"] == 200000
+    assert rows[1]["date"] == datetime.date(2018, 8, 2)
+    assert rows[1]["payee"] == "Lorenzo Giudici"
+    assert rows[1]["reason"] == "Tanti Auguri!"
+    assert rows[1]["reference"] == "BBBBBBBB"
+    assert rows[8]["trntype"] == "PAYMENT"
+    assert rows[8]["operation"] == "AAAA"
+    assert rows[8]["card"] == "123456"
+    assert rows[8]["account_id"] == "BancoPosta"
+
+    # a failed export leaves the previous file in place and no partial one
+    broken = tmp_path / "broken.csv"
+    broken.write_text("Data;Valuta;Addebiti;Accrediti;Descrizione operazioni\n01/08/18;01/08/18;1,0x;;COMMISSIONE\n")
+    assert bancopostacli.run(["export", "--batch-size", "4", "-o", output, inputs[0], str(broken)]) == 2
+    assert sorted(os.listdir(tmp_path)) == ["broken.csv", "transactions.parquet"]
+    assert pyarrow.parquet.read_table(output).num_rows == 9
+    assert bancopostacli.run(["export", "-o", str(tmp_path / "new.arrow"), str(broken)]) == 2
+    assert sorted(os.listdir(tmp_path)) == ["broken.csv", "transactions.parquet"]
+
+def test_bancoposta_memo() -> None:
+    plugin = BancoPostaPlugin(UI(), {})
+    filename = os.path.join(HERE, "samples", "transactions", "commissione_duplicata.csv")
+
+    statement = plugin.get_parser(filename).parse()
+    assert plugin.memo.hits == 1
+    assert plugin.memo.misses == 2
+    assert statement.lines[1].payee is statement.lines[2].payee
+
+    # the memo is shared by all the files parsed by the plugin
+    statement = plugin.get_parser(filename).parse()
+    assert plugin.memo.hits == 4
+    assert plugin.memo.misses == 2
+    assert [line.payee for line in statement.lines] == ["COMMISSIONE BONIFICO INSTANT", "COMMISSIONE", "COMMISSIONE"]
+
+    plugin = BancoPostaPlugin(UI(), {"memo_size": "0"})
+    plugin.get_parser(filename).parse()
+    assert plugin.memo is None
+
+def test_bancoposta_ocr_words_to_rows() -> None:
+    tsv = "\n".join([
+        "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext",
+        "5\t1\t1\t1\t1\t1\t10\t10\t40\t20\t95\tData",
+        "5\t1\t1\t1\t1\t2\t120\t11\t50\t20\t95\tValuta",
+        "5\t1\t1\t1\t1\t3\t240\t10\t60\t20\t95\tAddebiti",
+        "5\t1\t1\t1\t1\t4\t360\t10\t60\t20\t95\tAccrediti",
+        "5\t1\t1\t1\t1\t5\t480\t10\t90\t20\t95\tDescrizione",
+        "5\t1\t1\t1\t1\t6\t580\t10\t90\t20\t95\toperazioni",
+        "5\t1\t2\t1\t1\t1\t10\t50\t80\t20\t91\t03/01/18",
+        "5\t1\t2\t1\t1\t2\t120\t52\t80\t20\t90\t03/01/18",
+        "5\t1\t2\t1\t1\t3\t260\t50\t40\t20\t88\t2,90",
+        "5\t1\t2\t1\t1\t4\t480\t49\t70\t20\t93\tIMPOSTA",
+        "5\t1\t2\t1\t1\t5\t555\t50\t20\t20\t93\tDI",
+        "5\t1\t2\t1\t1\t6\t580\t50\t60\t20\t93\tBOLLO",
+        "5\t1\t3\t1\t1\t1\t480\t80\t70\t20\t93\tSEGUE",
+    ])
+
+    rows = bancopostaocr.words_to_rows(bancopostaocr.parse_tsv(tsv), 700)
+
+    assert rows == [
+        ["03/01/18", "03/01/18", "2,90", "nan", "IMPOSTA DI BOLLO"],
+        ["nan", "nan", "nan", "nan", "SEGUE"],
+    ]
+
+
+def test_bancoposta_page_has_text() -> None:
+    scanned = PyPDF2.PdfReader(os.path.join(HERE, "samples", "scanned.pdf"))
+    assert not bancopostaocr.page_has_text(scanned.pages[0])
+    # the text is drawn by a Form XObject, with the fonts in its own resources
+    form = PyPDF2.PdfReader(os.path.join(HERE, "samples", "form_text.pdf"))
+    assert "/Font" not in form.pages[0]["/Resources"]
+    assert bancopostaocr.page_has_text(form.pages[0])
+
+
+def test_bancoposta_ocr(tmp_path, monkeypatch) -> None:
+    calls = []
+    sources = []
+
+    def ocr_page(filename, page_number, area, dpi, lang):
+        calls.append(page_number)
+        with open(filename, "rb") as f:
+            sources.append(f.read())
+        return [
+            ["31/12/17", "nan", "nan", "100,95", "SALDO INIZIALE"],
+            ["03/01/18", "03/01/18", "2,90", "nan", "IMPOSTA DI BOLLO"],
+            ["31/01/18", "nan", "nan", "98,05", "SALDO FINALE"],
+        ]
+
+    def read_pdf(*args, **kwargs):
+        raise AssertionError("scanned pages have no text for tabula")
+
+    monkeypatch.setattr(bancopostaocr, "ocr_page", ocr_page)
+    monkeypatch.setattr(bancopostaocr.OcrExtractor, "available", staticmethod(lambda: True))
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", read_pdf)
+
+    plugin = BancoPostaPlugin(UI(), {"balance_check": "strict", "cache_dir": str(tmp_path), "ocr_workers": "1"})
+    filename = os.path.join(HERE, "samples", "scanned.pdf")
+
+    statement = plugin.get_parser(filename).parse()
+    assert len(statement.lines) == 1
+    assert statement.lines[0].payee == "IMPOSTA DI BOLLO"
+    assert statement.end_balance == Decimal("98.05")
+
+    # the OCR output is cached by page content
+    statement = plugin.get_parser(filename).parse()
+    assert len(statement.lines) == 1
+    assert calls == [1]
+
+    # a PDF read in memory is OCRed from the temporary file tabula reads too
+    with open(filename, "rb") as f:
+        pdf_data = f.read()
+    compressed = tmp_path / "scanned.pdf.gz"
+    compressed.write_bytes(gzip.compress(pdf_data))
+    plugin = BancoPostaPlugin(UI(), {"cache_dir": str(tmp_path / "cache"), "ocr_workers": "1"})
+    statement = plugin.get_parser(str(compressed)).parse()
+    assert len(statement.lines) == 1
+    assert sources == [pdf_data, pdf_data]
+
+def test_bancoposta_ocr_window(tmp_path, monkeypatch) -> None:
+    events = []
+
+    class Executor:
+        def __init__(self, max_workers):
+            pass
+
+        def submit(self, fn, filename, page, area, dpi, lang):
+            events.append(("submit", page))
+            future = Future()
+            future.set_result([[f"page {page}"]])
+            return future
+
+        def shutdown(self, cancel_futures=False):
+            pass
+
+    def load_pickle(filename):
+        events.append(("load", int(os.path.basename(filename).split("-")[2])))
+        return [["cached"]]
+
+    class Reader:
+        pages = list(range(1, 21))
+
+    monkeypatch.setattr(bancopostaocr, "ProcessPoolExecutor", Executor)
+    monkeypatch.setattr(bancopostaocr, "load_pickle", load_pickle)
+    monkeypatch.setattr(bancopostaocr, "page_content_hash", str)
+
+    extractor = bancopostaocr.OcrExtractor(workers=2, cache_path=str(tmp_path))
+    monkeypatch.setattr(extractor, "cache_file", lambda page, area: str(tmp_path / f"ocr-1-{page}"))
+    # even pages are cached
+    for page in range(2, 21, 2):
+        (tmp_path / f"ocr-1-{page}").touch()
+
+    yielded = []
+    for page, rows in extractor.extract("statement.pdf", Reader(), {page: (0, 0, 0, 0) for page in range(1, 21)}):
+        assert rows == ([["cached"]] if page % 2 == 0 else [[f"page {page}"]])
+        yielded.append(page)
+        # at most two pages per worker ahead, cached pages loaded in turn
+        assert max(p for kind, p in events) <= page + 3
+        assert [p for kind, p in events if kind == "load"] == [p for p in yielded if p % 2 == 0]
+    assert yielded == list(range(1, 21))
+    assert [p for kind, p in events if kind == "submit"] == list(range(1, 21, 2))
+
+
+def test_bancoposta_store(tmp_path) -> None:
+    db = str(tmp_path / "transactions.db")
+    plugin = BancoPostaPlugin(UI(), {"store": db})
+    for sample in ["bonifico.csv", "postagiro.csv", "bonifico.csv"]:
+        plugin.get_parser(os.path.join(HERE, "samples", "transactions", sample)).parse()
+
+    # converting the same statement twice does not duplicate its transactions
+    assert len(list(plugin.store.search(limit=0))) == 14
+
+    results = list(plugin.store.search("lorenzo giud"))
+    assert len(results) == 8
+    assert results[0]["settlement_date"] == "2018-08-05"
+
+    results = list(plugin.store.search("cresima"))
+    assert len(results) == 1
+    assert results[0]["amount"] == Decimal("500.50")
+    assert results[0]["payee"] == "Lorenzo Giudici"
+    assert results[0]["reason"] == "Buona Cresima"
+
+    results = list(plugin.store.search("regalo", since="2018-08-05", until="2018-08-10"))
+    assert [r["memo"] for r in results] == ["BONIFICO Da Lorenzo Giudici per Regalo 2024 TRN 0306964772471211485291052910IT BCITITMMXXX"]
+    plugin.store.close()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_bancoposta_watch(tmp_path, polling) -> None:
+    if not polling and not InotifyWatcher.supported():
+        pytest.skip("inotify not available")
+
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    shutil.copy(os.path.join(HERE, "samples", "transactions", "atm.csv"), inbox / "before.csv")
+
+    watcher = DirectoryWatcher(str(inbox), {}, output_dir=str(tmp_path / "ofx"),
+                               workers=2, settle_time=0.2, polling=polling)
+    watcher_stop = threading.Event()
+    thread = threading.Thread(target=watcher.run, args=(watcher_stop,))
+    thread.start()
+    try:
+        # a statement written in two steps is converted only once it is complete
+        with open(os.path.join(HERE, "samples", "transactions", "pagamento_postamat.csv"), "rb") as f:
+            data = f.read()
+        with open(inbox / "after.csv", "wb") as f:
+            f.write(data[:20])
+            f.flush()
+            time.sleep(0.1)
+            f.write(data[20:])
+        (inbox / "broken.csv").write_text("not;a;statement\n")
+        (inbox / "notes.txt").write_text("ignored")
+
+        deadline = time.monotonic() + 30
+        while watcher.converted + watcher.failed < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        watcher_stop.set()
+        thread.join()
+
+    assert (watcher.converted, watcher.failed) == (2, 1)
+    assert sorted(os.listdir(tmp_path / "ofx")) == ["after.csv.ofx", "before.csv.ofx"]
+    assert sorted(os.listdir(inbox / "done")) == ["after.csv", "before.csv"]
+    assert os.listdir(inbox / "failed") == ["broken.csv"]
+    assert sorted(os.listdir(inbox)) == ["done", "failed", "notes.txt"]
+    assert "<STMTTRN>" in (tmp_path / "ofx" / "after.csv.ofx").read_text()
+
+
+def test_bancoposta_watch_collect(tmp_path) -> None:
+    # statements of different types with the same name get their own OFX file
+    assert output_name("EC_2023.csv") != output_name("EC_2023.pdf")
+    assert output_name("EC_2023.csv") != output_name("EC_2023.csv.gz")
+
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    watcher = DirectoryWatcher(str(inbox), {}, output_dir=str(tmp_path / "ofx"))
+    done = Future()
+    done.set_result(str(tmp_path / "ofx" / "gone.csv.ofx"))
+    failed = Future()
+    failed.set_exception(ValueError("not a statement"))
+    # inputs removed while being converted do not stop the watcher
+    watcher.running = {"gone.csv": done, "broken.csv": failed}
+    watcher.collect()
+    assert (watcher.converted, watcher.failed) == (1, 1)
+    assert watcher.running == {}
+
+
+def test_bancoposta_csv_chunks(tmp_path) -> None:
+    rows = []
+    for day in range(1, 29):
+        rows += [
+            f"{day:02d}/08/18;{day:02d}/08/18;1,00;;COMMISSIONE",
+            f"{day:02d}/08/18;{day:02d}/08/18;;100,55;\"BONIFICO TRN BBBBBBBB DA Lorenzo Giudici\nPER Regalo; \"\"{day}\"\"\"",
+            f"{day:02d}/08/18;{day:02d}/08/18;50,00;;PRELIEVO UP 1234 ATM 12345 CARTA 12345678",
+            # a bare quote inside an unquoted field does not open a quoted field
+            f"{day:02d}/08/18;{day:02d}/08/18;1,00;;PAGAMENTO POSTAMAT MONITOR 27\" 5",
+        ]
+    content = "\n".join(
+        ["Data;Valuta;Addebiti;Accrediti;Descrizione operazioni", "31/12/17;;;100,95|;SALDO INIZIALE"]
+        + rows * 20 + ["31/08/18;;;27.288,95|;SALDO FINALE", ""])
+    filename = str(tmp_path / "large.csv")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(content)
+
+    # ranges cover the file after the header, ending on record boundaries, never inside quotes
+    ranges = list(split_ranges(filename, 1000))
+    assert len(ranges) > 50
+    data = content.encode("utf-8")
+    assert ranges[0][0] == data.index(b"\n") + 1
+    assert ranges[-1][1] == len(data)
+    for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start
+        assert data[end - 1:end] == b"\n"
+    # and read chunk by chunk, they give the records of the whole file
+    chunked = []
+    for start, end in ranges:
+        chunked += csv.reader(io.StringIO(data[start:end].decode("utf-8"), newline=""), delimiter=";")
+    assert chunked == list(csv.reader(io.StringIO(content, newline=""), delimiter=";"))[1:]
+
+    def parse(workers, chunk_size=1000):
+        plugin = BancoPostaPlugin(UI(), {"csv_workers": str(workers), "balance_check": "strict"})
+        parser = plugin.get_parser(filename)
+        parser.chunk_size = chunk_size
+        return parser.parse()
+
+    sequential = parse(1)
+    parallel = parse(3)
+    assert len(parse(2, 500).lines) == len(rows) * 20
+    assert len(parallel.lines) == len(rows) * 20
+    assert [(l.id, l.date, l.amount, l.trntype, l.payee, l.memo) for l in parallel.lines] == \
+        [(l.id, l.date, l.amount, l.trntype, l.payee, l.memo) for l in sequential.lines]
+    # occurrence counters continue across chunks
+    assert len({l.id for l in parallel.lines}) == len(parallel.lines)
+    assert parallel.lines[-1].id.endswith("-19")
+    assert parallel.end_balance == Decimal("27288.95")
+
+
+def test_bancoposta_lenient(tmp_path, caplog) -> None:
+    filename = str(tmp_path / "broken.csv")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join([
+            "Data;Valuta;Addebiti;Accrediti;Descrizione operazioni",
+            "31/12/17;;;100,95|;SALDO INIZIALE",
+            "01/08/18;01/08/18;1,00;;COMMISSIONE",
+            "02/08/18;02/08/18;;;COMMISSIONE",
+            "03/08/18;03/08/18;1,0x;;COMMISSIONE",
+            "04/08/18;04/08/18;1,00;;COMMISSIONE",
+            # the bank's balance includes the row that cannot be read
+            "31/08/18;;;97,95|;SALDO FINALE",
+        ]) + "\n")
+
+    # strict: the first bad row aborts the conversion with its line number
+    with pytest.raises(ParseError) as excinfo:
+        BancoPostaPlugin(UI(), {}).get_parser(filename).parse()
+    assert excinfo.value.lineno == 4
+
+    quarantine = str(tmp_path / "quarantine.jsonl")
+    plugin = BancoPostaPlugin(UI(), {"on_error": "lenient", "quarantine": quarantine, "balance_check": "strict"})
+    parser = plugin.get_parser(filename)
+    statement = parser.parse()
+    plugin.quarantine.close()
+
+    assert [line.date.day for line in statement.lines] == [1, 4]
+    assert parser.errors == {"ParseError": 2}
+    with open(quarantine, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["file"], r["line"], r["error"]) for r in records] == [(filename, 4, "ParseError"), (filename, 5, "ParseError")]
+    assert records[1]["message"] == "Invalid amount '1,0x'"
+    assert records[1]["raw"] == {"Data": "03/08/18", "Valuta": "03/08/18", "Addebiti": "1,0x",
+                                 "Accrediti": "", "Descrizione operazioni": "COMMISSIONE"}
+    # the balances include the quarantined rows: they are left out and the
+    # statement can still be written, whatever the balance_check
+    assert statement.start_balance is None and statement.end_balance is None
+    statement.assert_valid()
+    for mode in ["warn", "off"]:
+        plugin = BancoPostaPlugin(UI(), {"on_error": "lenient", "balance_check": mode})
+        plugin.get_parser(filename).parse().assert_valid()
+    assert "line 5 skipped: Invalid amount '1,0x'" in caplog.text
+    config = tmp_path / "config.ini"
+    config.write_text("[bancoposta]\nplugin = bancoposta\non_error = lenient\n")
+    ofx_file = tmp_path / "broken.ofx"
+    assert bancopostacli.run(["-c", str(config), "convert", "--ofx", str(ofx_file), filename]) == 0
+    assert ofx_file.read_text().count("<STMTTRN>") == 2
+
+    # same result when the rows are parsed by chunk workers
+    plugin = BancoPostaPlugin(UI(), {"on_error": "lenient", "csv_workers": "2"})
+    parser = plugin.get_parser(filename)
+    parser.chunk_size = 100
+    assert [line.date.day for line in parser.parse().lines] == [1, 4]
+    assert parser.errors == {"ParseError": 2}
+
+    with pytest.raises(ValueError):
+        ATMTransaction(None, None, Decimal(1), "ATM 1234", None)
+
+
+def test_bancoposta_lenient_balance_mismatch(tmp_path) -> None:
+    filename = os.path.join(HERE, "samples", "bancoposta.csv")
+    quarantine = str(tmp_path / "quarantine.jsonl")
+
+    # a balance that does not reconcile is not a malformed row: strict balance_check still aborts
+    plugin = BancoPostaPlugin(UI(), {"on_error": "lenient", "quarantine": quarantine, "balance_check": "strict"})
+    parser = plugin.get_parser(filename)
+    with pytest.raises(BalanceMismatch):
+        parser.parse()
+    assert parser.statement.end_balance == Decimal("28359.05")
+    assert not parser.errors
+    assert not os.path.exists(quarantine)
+
+    plugin = BancoPostaPlugin(UI(), {"on_error": "lenient", "quarantine": quarantine, "balance_check": "warn"})
+    parser = plugin.get_parser(filename)
+    statement = parser.parse()
+    assert statement.end_balance is None
+    assert len(statement.lines) == 4
+    assert not parser.errors
+
+
+def test_bancoposta_window(monkeypatch) -> None:
+    plugin = BancoPostaPlugin(UI(), {"since": "2018-08-02", "until": "2018-08-04", "balance_check": "strict"})
+    statement = plugin.get_parser(os.path.join(HERE, "samples", "transactions", "bonifico.csv")).parse()
+    assert {line.date for line in statement.lines} == {datetime.datetime(2018, 8, d) for d in (2, 3, 4)}
+    # the balances of the whole statement do not apply to the window
+    assert statement.start_balance is None and statement.end_balance is None
+
+    # one page per month, a continuation row on each following page; the
+    # operations of the 10th were settled at the end of the previous month
+    month_pages = {
+        month: [
+            [None, None, None, None, "CONTINUATION"],
+            ["10/%02d/18" % month, "28/%02d/18" % (month - 1 or 12), "1,00", None, "COMMISSIONE"],
+            ["20/%02d/18" % month, "25/%02d/18" % month, None, "2,00", "ACCREDITO"],
+        ]
+        for month in range(1, 13)
+    }
+    read_pages = []
+
+    def read_pdf(filename, pages=None, pandas_options=None, **kwargs):
+        read_pages.append(int(pages))
+        return fake_read_pdf(month_pages)(filename, pages, pandas_options)
+
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", read_pdf)
+    monkeypatch.setattr(bancopostapdfparser, "page_dates",
+                        lambda page, date_format: [datetime.datetime(2018, page, 10), datetime.datetime(2018, page, 25)])
+
+    class Reader:
+        pages = list(range(1, 13))
+
+    class Layout:
+        def area(self, reader, page):
+            return (0, 0, 0, 0)
+
+    class Operations:
+        def __init__(self):
+            self.lines = []
+
+        def add_line(self, statement, transaction, stmt_line):
+            self.lines.append((transaction.date, stmt_line.id))
+
+    def parse_pdf(settings):
+        parser = BancoPostaPlugin(UI(), dict(settings, ocr="off")).get_parser("statement.pdf")
+        parser.reader = Reader()
+        parser.layout_detector = Layout()
+        operations = Operations()
+        parser.sinks.append(operations)
+        return parser.parse(), operations.lines
+
+    since, until = datetime.datetime(2018, 3, 15), datetime.datetime(2018, 5, 31)
+    statement, operations = parse_pdf({"since": "2018-03-15", "until": "2018-05-31"})
+
+    assert [line.date for line in statement.lines] == [
+        datetime.datetime(2018, 3, 25), datetime.datetime(2018, 3, 28), datetime.datetime(2018, 4, 25),
+        datetime.datetime(2018, 4, 28), datetime.datetime(2018, 5, 25),
+    ]
+    assert statement.lines[0].memo == "ACCREDITO CONTINUATION"
+    # pages before since are skipped, and extraction stops on the first page past until
+    assert read_pages == [3, 4, 5, 6]
+
+    # the same transactions as a full parse filtered afterwards on the same date
+    read_pages.clear()
+    _, all_operations = parse_pdf({})
+    assert read_pages == list(range(1, 13))
+    assert operations == [(date, id) for date, id in all_operations if since <= date <= until]
+
+
+def test_bancoposta_window_ids(tmp_path, monkeypatch) -> None:
+    # the same key: the first one settled the day after it was made
+    filename = str(tmp_path / "window.csv")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join([
+            "Data;Valuta;Addebiti;Accrediti;Descrizione operazioni",
+            "31/07/18;01/08/18;1,00;;COMMISSIONE",
+            "01/08/18;01/08/18;1,00;;COMMISSIONE",
+        ] + ["02/08/18;02/08/18;1,00;;COMMISSIONE"] * 100) + "\n")
+
+    full = [line.id for line in BancoPostaPlugin(UI(), {}).get_parser(filename).parse().lines]
+    assert full[1] == full[0] + "-1"
+    # rows out of the window still count: ids are the same as in a full parse
+    for workers in [1, 2]:
+        parser = BancoPostaPlugin(UI(), {"since": "2018-08-01", "csv_workers": str(workers)}).get_parser(filename)
+        parser.chunk_size = 500
+        assert [line.id for line in parser.parse().lines] == full[1:]
+
+    # PDF: the page skipped before since has a transaction with the same key
+    # as one of the next page, so it is read for the ids
+    pdf_pages = {
+        1: [["30/07/18", "31/07/18", "1,00", None, "COMMISSIONE"]],
+        2: [["01/08/18", "31/07/18", "1,00", None, "COMMISSIONE"],
+            ["02/08/18", "02/08/18", "2,00", None, "COMMISSIONE"]],
+        3: [["03/08/18", "03/08/18", "3,00", None, "COMMISSIONE"]],
+    }
+    read_pages = []
+
+    def read_pdf(filename, pages=None, pandas_options=None, **kwargs):
+        read_pages.append(int(pages))
+        return fake_read_pdf(pdf_pages)(filename, pages, pandas_options)
+
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", read_pdf)
+    monkeypatch.setattr(bancopostapdfparser, "page_dates", lambda page, date_format: [
+        datetime.datetime.strptime(date, "%d/%m/%y") for row in pdf_pages[page] for date in row[:2]])
+
+    class Reader:
+        pages = [1, 2, 3]
+
+    class Layout:
+        def area(self, reader, page):
+            return (0, 0, 0, 0)
+
+    def parse_pdf(settings):
+        parser = BancoPostaPlugin(UI(), dict(settings, ocr="off")).get_parser("statement.pdf")
+        parser.reader = Reader()
+        parser.layout_detector = Layout()
+        read_pages.clear()
+        return [line.id for line in parser.parse().lines]
+
+    full = parse_pdf({})
+    assert full[1] == full[0] + "-1"
+    assert parse_pdf({"since": "2018-08-01"}) == full[1:]
+    assert read_pages == [2, 1, 3]
+    # no shared settlement date: the skipped pages are not read at all
+    assert parse_pdf({"since": "2018-08-03"}) == full[3:]
+    assert read_pages == [3]
+
+
+def test_bancoposta_archives(tmp_path, monkeypatch) -> None:
+    tabula_files = []
+
+    def read_pdf(filename, pages=None, pandas_options=None, **kwargs):
+        tabula_files.append(filename)
+        return fake_read_pdf(PDF_PAGES)(filename, pages, pandas_options)
+
+    monkeypatch.setattr(bancopostapdfparser.tabula, "read_pdf", read_pdf)
+
+    def lines(statement):
+        return [(line.id, line.date, line.amount, line.payee) for line in statement.lines]
+
+    settings = {"cache_dir": str(tmp_path), "ocr": "off"}
+    csv_sample = os.path.join(HERE, "samples", "transactions", "bonifico.csv")
+    pdf_sample = os.path.join(HERE, "samples", "layout.pdf")
+    expected_csv = lines(BancoPostaPlugin(UI(), settings).get_parser(csv_sample).parse())
+    expected_pdf = lines(BancoPostaPlugin(UI(), settings).get_parser(pdf_sample).parse())
+    with open(csv_sample, "rb") as f:
+        csv_data = f.read()
+    with open(pdf_sample, "rb") as f:
+        pdf_data = f.read()
+
+    # compressed statements
+    for suffix, compress in [(".gz", gzip.compress), (".bz2", bz2.compress), (".xz", lzma.compress)]:
+        filename = tmp_path / ("bonifico.csv" + suffix)
+        filename.write_bytes(compress(csv_data))
+        parser = BancoPostaPlugin(UI(), settings).get_parser(str(filename))
+        assert lines(parser.parse()) == expected_csv
+
+    filename = tmp_path / "layout.pdf.gz"
+    filename.write_bytes(gzip.compress(pdf_data))
+    tabula_files.clear()
+    assert lines(BancoPostaPlugin(UI(), settings).get_parser(str(filename)).parse()) == expected_pdf
+    # tabula needs a file: the PDF is written once and removed afterwards
+    assert len(set(tabula_files)) == 1 and not os.path.exists(tabula_files[0])
+
+    # archives, with the lines of all the statements
+    zip_name = str(tmp_path / "statements.zip")
+    with zipfile.ZipFile(zip_name, "w") as archive:
+        archive.writestr("2018/bonifico.csv", csv_data)
+        archive.writestr("2018/layout.pdf", pdf_data)
+        archive.writestr("2018/bonifico.csv.gz", gzip.compress(csv_data))
+        archive.writestr("README.txt", "not a statement")
+    tar_name = str(tmp_path / "statements.tar.gz")
+    with tarfile.open(tar_name, "w:gz") as archive:
+        archive.add(csv_sample, "bonifico.csv")
+        archive.add(pdf_sample, "layout.pdf")
+        archive.add(str(tmp_path / "bonifico.csv.xz"), "bonifico.csv.xz")
+
+    for name in [zip_name, tar_name]:
+        plugin = BancoPostaPlugin(UI(), settings)
+        parser = plugin.get_parser(name)
+        statement = parser.parse()
+        assert lines(statement) == expected_csv + expected_pdf + expected_csv
+        assert [s.account_id for s in parser.statements] == ["BancoPosta"] * 3
+        # the balances of bonifico.csv do not reconcile and are left out
+        assert statement.start_balance is None and statement.end_balance is None
+        statement.assert_valid()
+
+
+def test_bancoposta_tee_output(tmp_path) -> None:
+    filename = os.path.join(HERE, "samples", "transactions", "atm.csv")
+    ofx_file, csv_file, json_file = (str(tmp_path / name) for name in ["out.ofx", "out.csv", "out.json"])
+    assert bancopostacli.run(["convert", "--ofx", ofx_file, "--csv", csv_file, "--json", json_file, filename]) == 0
+
+    statement = BancoPostaPlugin(UI(), {}).get_parser(filename).parse()
+    with open(ofx_file, encoding="utf-8") as f:
+        assert f.read().count("<STMTTRN>") == len(statement.lines)
+    with open(csv_file, encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    with open(json_file, encoding="utf-8") as f:
+        document = json.load(f)
+
+    assert [row["id"] for row in rows] == [line.id for line in statement.lines]
+    assert [t["amount"] for t in document["transactions"]] == [str(line.amount) for line in statement.lines]
+    assert rows[0]["payee"] == document["transactions"][0]["payee"] == "VERSAMENTO"
+    assert rows[0]["settlement_date"] == statement.lines[0].date.strftime("%Y-%m-%d")
+    assert document["start_balance"] == str(statement.start_balance)
+    assert document["end_balance"] == str(statement.end_balance)
+    assert sorted(os.listdir(tmp_path)) == ["out.csv", "out.json", "out.ofx"]
+
+    # per format field mapping
+    config = tmp_path / "config.ini"
+    config.write_text("[bancoposta]\nplugin = bancoposta\ncsv_fields = Data=settlement_date, Importo=amount, payee\ncsv_delimiter = ;\n")
+    assert bancopostacli.run(["-c", str(config), "convert", "--csv", csv_file, filename]) == 0
+    with open(csv_file, encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f, delimiter=";"))
+    assert rows[0] == ["Data", "Importo", "payee"]
+    assert rows[1] == [statement.lines[0].date.strftime("%Y-%m-%d"), str(statement.lines[0].amount), "VERSAMENTO"]
+
+    # a statement that cannot be parsed leaves no output behind
+    (tmp_path / "in").mkdir()
+    broken = tmp_path / "in" / "broken.csv"
+    broken.write_text("Data;Valuta;Addebiti;Accrediti;Descrizione operazioni\n01/08/18;01/08/18;1,0x;;COMMISSIONE\n")
+    assert bancopostacli.run(["convert", "--ofx", str(tmp_path / "broken.ofx"), "--json", str(tmp_path / "broken.json"), str(broken)]) == 2
+    assert sorted(os.listdir(tmp_path)) == ["config.ini", "in", "out.csv", "out.json", "out.ofx"]